@@ -6,8 +6,28 @@ import time
 import json
 import shutil
 import sqlite3
+import contextlib
+from pathlib import Path
+import copy
+import hashlib
+import struct
+import base64
+import tempfile
+from collections import OrderedDict
+from urllib.parse import urlparse
 import sys
-from typing import List, Tuple, Dict, Optional, Any, Union
+import socket
+import signal
+import argparse
+from datetime import datetime
+import asyncio
+import functools
+import threading
+import contextvars
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Executor
+from typing import List, Tuple, Dict, Optional, Any, Union, Iterator, AsyncIterator, Callable, NamedTuple
 
 # Configure logging
 logging.basicConfig(
@@ -25,8 +45,12 @@ logger.info(f"Current directory: {os.getcwd()}")
 
 # Directly import required packages (for PythonAnywhere compatibility)
 from dotenv import load_dotenv
+from telegram.error import RetryAfter
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
-from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import (
+    Bot, Chat, Message, Update, InlineKeyboardButton, InlineKeyboardMarkup,
+    InputMediaAudio, InputMediaDocument, InputMediaVideo
+)
 import yt_dlp
 
 # Load environment variables from .env file
@@ -44,14 +68,102 @@ if not TOKEN:
     TOKEN = "TELEGRAM_BOT_TOKEN"
     
 DOWNLOAD_DIR = 'downloads'
-MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB - Telegram bot API limit
+# Optional self-hosted telegram-bot-api server (e.g. http://localhost:8081/bot)
+BOT_API_BASE_URL = os.getenv('BOT_API_BASE_URL', '')
+BOT_API_BASE_FILE_URL = os.getenv('BOT_API_BASE_FILE_URL', BOT_API_BASE_URL.replace('/bot', '/file/bot'))
+# Local mode: the server shares our filesystem and reads uploads from file:// paths
+BOT_API_LOCAL_MODE = bool(BOT_API_BASE_URL) and os.getenv('BOT_API_LOCAL_MODE', '0') == '1'
+if BOT_API_LOCAL_MODE:
+    MAX_FILE_SIZE = 2000 * 1024 * 1024  # 2000MB - local Bot API server limit
+else:
+    MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB - Telegram bot API limit
+MAX_FILE_SIZE_MB = MAX_FILE_SIZE // (1024 * 1024)
 ADMIN_ID = os.getenv('ADMIN_ID', 'ADMIN_ID')  # Admin user ID to receive notifications
 DB_PATH = 'bot_users.db'  # SQLite database path
 CONFIG_PATH = 'bot_config.json'  # Configuration file path
 CHANNEL_USERNAME = "bad_wolf_01"  # Channel username without @ (required for subscription)
 CHANNEL_LINK = "https://t.me/bad_wolf_01"  # Full channel link for invitation
+MAX_CONCURRENT_DOWNLOADS = int(os.getenv('MAX_CONCURRENT_DOWNLOADS', '4'))  # Download jobs running at once
+DOWNLOAD_POOL_TYPE = os.getenv('DOWNLOAD_POOL_TYPE', 'thread')  # 'thread' or 'process'
+FIT_REENCODE = os.getenv('FIT_REENCODE', '0') == '1'  # Re-encode 'fit' downloads when no format fits
+FIT_SIZE_MARGIN = 0.9  # Share of MAX_FILE_SIZE targeted by 'fit' (sizes are estimates)
+FIT_MIN_VIDEO_BITRATE = 150_000  # Below this a re-encode isn't worth watching; split instead
+MAX_DOWNLOAD_SIZE = int(os.getenv('MAX_DOWNLOAD_SIZE', str(2 * 1024 * 1024 * 1024)))  # Larger media is refused
+PROBE_CACHE_TTL = int(os.getenv('PROBE_CACHE_TTL', '600'))  # Seconds probed metadata is reused (media URLs expire)
+PROBE_CACHE_MAX = int(os.getenv('PROBE_CACHE_MAX', '100'))  # Probed URLs kept in memory
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '3'))  # Min seconds between status edits per chat
+URL_TOKEN_TTL = int(os.getenv('URL_TOKEN_TTL', str(2 * 24 * 3600)))  # Seconds a quality button stays usable
+URL_TOKEN_MAX = int(os.getenv('URL_TOKEN_MAX', '10000'))  # URL tokens kept in memory
+URL_TOKEN_PERSIST = os.getenv('URL_TOKEN_PERSIST', '1') == '1'  # Keep URL tokens in the database across restarts
+URL_TOKEN_MAX_ATTEMPTS = 8  # Alternative tokens tried when one is taken by another URL
+SUBSCRIPTION_CACHE_TTL = int(os.getenv('SUBSCRIPTION_CACHE_TTL', '600'))  # Seconds a confirmed membership is trusted
+SUBSCRIPTION_NEGATIVE_TTL = int(os.getenv('SUBSCRIPTION_NEGATIVE_TTL', '30'))  # Seconds a "not subscribed" answer is trusted
+SUBSCRIPTION_CACHE_MAX_USERS = 100000  # Upper bound on cached membership results
+PER_USER_MAX_JOBS = int(os.getenv('PER_USER_MAX_JOBS', '2'))  # Download jobs one user can run at once
+USER_JOBS_PER_MINUTE = float(os.getenv('USER_JOBS_PER_MINUTE', '6'))  # Sustained rate of new jobs per user
+USER_JOBS_BURST = int(os.getenv('USER_JOBS_BURST', '3'))  # New jobs a user can start back to back
+RATE_LIMIT_MAX_USERS = 100000  # Rate-limit buckets kept before full ones are forgotten
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))  # Restarts a job may be resumed after before it is dropped
+EMBEDDED_WORKER = os.getenv('EMBEDDED_WORKER', '1') == '1'  # The bot process also runs download jobs
+WORKER_ID = os.getenv('WORKER_ID', f"{socket.gethostname()}:{os.getpid()}")  # Name of this process in jobs and leases
+WORKER_POLL_INTERVAL = float(os.getenv('WORKER_POLL_INTERVAL', '2'))  # Seconds between checks for queued jobs
+WORKER_HEARTBEAT_INTERVAL = 10  # Seconds between heartbeats of a worker's running jobs
+WORKER_TIMEOUT = int(os.getenv('WORKER_TIMEOUT', '60'))  # Jobs without a heartbeat for this long are requeued
+LEASE_TTL = int(os.getenv('LEASE_TTL', '30'))  # Seconds the frontend role is held without renewal
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Public HTTPS URL of the bot; empty to use polling
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')  # URL path the webhook is served on
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')  # Secret token Telegram sends with every update
+STORAGE_MIN_FREE = int(os.getenv('STORAGE_MIN_FREE', str(1024 * 1024 * 1024)))  # Bytes always left free on the download disk
+STORAGE_QUOTA = int(os.getenv('STORAGE_QUOTA', '0'))  # Max bytes under DOWNLOAD_DIR (0 = only free space counts)
+STORAGE_DEFAULT_ESTIMATE = 200 * 1024 * 1024  # Reserved for media whose size couldn't be estimated
+STORAGE_OVERHEAD = 2  # Peak disk use per byte of media (separate streams + merge, or original + split parts)
+STORAGE_RETRY_INTERVAL = 10  # Seconds between checks while a job waits for space
+STORAGE_SWEEP_INTERVAL = int(os.getenv('STORAGE_SWEEP_INTERVAL', '600'))  # Seconds between sweeps of orphaned files
+ORPHAN_MAX_AGE = int(os.getenv('ORPHAN_MAX_AGE', '3600'))  # Seconds before a file no job owns is swept
+RECENT_FILES_MAX_BYTES = int(os.getenv('RECENT_FILES_MAX_BYTES', '0'))  # Recently sent files kept on disk (0 = off)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')  # Interface the /metrics endpoint listens on
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))  # Port of the /metrics endpoint (0 = off)
+QUEUE_STATS_TTL = 5  # Seconds the job queue gauges are reused between scrapes
+YDL_POOL_SIZE = int(os.getenv('YDL_POOL_SIZE', '6'))  # Warm YoutubeDL instances kept per download thread (0 = off)
+YDL_MAX_AGE = int(os.getenv('YDL_MAX_AGE', '3600'))  # Seconds before a warm YoutubeDL instance is rebuilt
+CONCURRENT_FRAGMENTS = int(os.getenv('CONCURRENT_FRAGMENTS', '4'))  # HLS/DASH fragments fetched in parallel per download
+HTTP_CHUNK_SIZE = int(os.getenv('HTTP_CHUNK_SIZE', str(10 * 1024 * 1024)))  # Bytes per ranged request of progressive downloads (0 = one request)
+EXTERNAL_DOWNLOADER = os.getenv('EXTERNAL_DOWNLOADER', '')  # 'aria2c' for multi-connection progressive downloads (used if installed)
+ARIA2C_CONNECTIONS = int(os.getenv('ARIA2C_CONNECTIONS', '8'))  # Connections aria2c opens per file
+BANDWIDTH_LIMIT = int(os.getenv('BANDWIDTH_LIMIT', '0'))  # Bytes/s shared by the downloads of one process (0 = unlimited)
+FFMPEG_MAX_PROCS = int(os.getenv('FFMPEG_MAX_PROCS', str(max(1, (os.cpu_count() or 2) // 2))))  # ffmpeg encodes running at once
+FFMPEG_THREADS = int(os.getenv('FFMPEG_THREADS', '2'))  # Threads each ffmpeg encode may use
+FFMPEG_NICE = int(os.getenv('FFMPEG_NICE', '10'))  # Niceness of ffmpeg encodes, so they yield to the bot
+AUDIO_BITRATE = os.getenv('AUDIO_BITRATE', '192k')  # Bitrate when audio has to be transcoded (MP3, or AAC inside videos)
+SPOTDL_FORMAT = os.getenv('SPOTDL_FORMAT', 'm4a')  # spotdl output, 'm4a' (YouTube's AAC as is) or 'mp3'
+PLAYLIST_PREFETCH = int(os.getenv('PLAYLIST_PREFETCH', '2'))  # Playlist items downloaded ahead of the one being sent
+DOWNLOAD_BATCH_SIZE = 50  # Queued download records that trigger an immediate write
+DOWNLOAD_FLUSH_INTERVAL = 5  # Seconds between batched writes of download records
+FILE_CACHE_TTL = int(os.getenv('FILE_CACHE_TTL', str(7 * 24 * 3600)))  # Seconds a cached file_id stays valid
+FILE_CACHE_MAX_ENTRIES = int(os.getenv('FILE_CACHE_MAX_ENTRIES', '5000'))  # Cached URL+quality entries kept
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
+SPLIT_BUFFER_SIZE = 1024 * 1024  # Copy buffer used when splitting files
+SEGMENT_SIZE_MARGIN = 0.95  # Planned video parts leave room for container overhead
+
+# Height limits of the video quality options
+QUALITY_HEIGHTS = {'high': 1080, 'medium': 720, 'low': 480}
+VIDEO_FORMAT_SORT = ['res', 'vcodec:h264', 'acodec:aac']  # Among equal resolutions prefer what Telegram plays
+
+# Probed metadata by URL: url -> (info, expires_at), oldest first
+_media_info_cache: "OrderedDict[str, Tuple[Dict[str, Any], float]]" = OrderedDict()
+# Probes in progress by cleaned URL, shared by concurrent requests for the same link
+_media_info_lookups: Dict[str, asyncio.Future] = {}
+
+# Media group item classes for re-sending cached files
+INPUT_MEDIA_TYPES = {
+    'video': InputMediaVideo,
+    'audio': InputMediaAudio,
+    'document': InputMediaDocument
+}
+
 # Load admin ID from config file if it exists
 def load_config():
     """Load configuration from file."""
@@ -90,35 +202,318 @@ load_config()
 
 # We've already configured logging, no need to do it again
 
+# --- Metrics ---
+# A small in-process registry, served in the Prometheus text format on
+# METRICS_HOST:METRICS_PORT/metrics and summarized in /stats. Metrics
+# recorded inside pool processes (DOWNLOAD_POOL_TYPE=process) are lost.
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+_metrics: List["Metric"] = []
+# Platform of the job being handled, for timers deep in the call stack
+current_platform: contextvars.ContextVar = contextvars.ContextVar('current_platform', default='none')
+
+class Metric:
+    """A labelled counter, gauge or histogram that can be updated from any thread.
+
+    Gauges may instead be given func, which is called for the current
+    value whenever metrics are rendered.
+    """
+    
+    def __init__(self, name: str, kind: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = STAGE_BUCKETS, func: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.kind = kind
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.func = func
+        # Label values -> value, or [cumulative bucket counts, sum, count] for histograms
+        self.values: Dict[Tuple[str, ...], Any] = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+    
+    def key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+    
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+    
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        with self.lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+    
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of a block."""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+    
+    def total(self, **labels) -> float:
+        """Sum of a counter or gauge over all series matching the given labels."""
+        with self.lock:
+            return sum(value for key, value in self.values.items()
+                       if all(key[self.labels.index(name)] == str(value_) for name, value_ in labels.items()))
+    
+    def merged(self, **labels) -> Optional[List[Any]]:
+        """Histogram series matching the given labels, added together."""
+        merged = None
+        with self.lock:
+            for key, (buckets, total, count) in self.values.items():
+                if any(key[self.labels.index(name)] != str(value) for name, value in labels.items()):
+                    continue
+                if merged is None:
+                    merged = [[0] * len(self.buckets), 0.0, 0]
+                merged[0] = [a + b for a, b in zip(merged[0], buckets)]
+                merged[1] += total
+                merged[2] += count
+        return merged
+    
+    def render(self) -> List[str]:
+        """Lines of the Prometheus text format for this metric."""
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        if self.func:
+            try:
+                lines.append(f"{self.name} {self.func()}")
+            except Exception as e:
+                logger.warning(f"Error reading metric {self.name}: {e}")
+            return lines
+        with self.lock:
+            items = [(key, copy.deepcopy(value)) for key, value in self.values.items()]
+        for key, value in items:
+            pairs = [f'{name}="{escape_label(label)}"' for name, label in zip(self.labels, key)]
+            if self.kind != 'histogram':
+                lines.append(f"{self.name}{format_labels(pairs)} {value}")
+                continue
+            buckets, total, count = value
+            for bound, bucket_count in zip(self.buckets, buckets):
+                bucket_pairs = pairs + [f'le="{bound}"']
+                lines.append(f"{self.name}_bucket{format_labels(bucket_pairs)} {bucket_count}")
+            bucket_pairs = pairs + ['le="+Inf"']
+            lines.append(f"{self.name}_bucket{format_labels(bucket_pairs)} {count}")
+            lines.append(f"{self.name}_sum{format_labels(pairs)} {total}")
+            lines.append(f"{self.name}_count{format_labels(pairs)} {count}")
+        return lines
+
+def escape_label(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(pairs: List[str]) -> str:
+    """Format name="value" pairs as a label set."""
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def render_metrics() -> str:
+    """All metrics in the Prometheus text format."""
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+def time_stage(stage: str, platform: Optional[str] = None):
+    """Time a block as one observation of a request stage."""
+    return STAGE_SECONDS.time(stage=stage, platform=platform or current_platform.get())
+
+def histogram_quantile(buckets: List[int], count: int, quantile: float, bounds: Tuple[float, ...]) -> Optional[float]:
+    """Upper bucket bound below which the given share of observations fall (None if beyond the last bucket)."""
+    for bound, bucket_count in zip(bounds, buckets):
+        if bucket_count >= quantile * count:
+            return bound
+    return None
+
+STAGE_SECONDS = Metric('bot_stage_duration_seconds', 'histogram',
+                       'Time spent in each stage of handling a request', ('stage', 'platform'))
+REQUESTS_TOTAL = Metric('bot_requests_total', 'counter', 'Finished download requests', ('platform', 'status'))
+DOWNLOADED_BYTES = Metric('bot_downloaded_bytes_total', 'counter', 'Bytes of media downloaded', ('platform',))
+UPLOADED_BYTES = Metric('bot_uploaded_bytes_total', 'counter', 'Bytes of media uploaded to Telegram', ('platform',))
+CACHE_LOOKUPS = Metric('bot_cache_lookups_total', 'counter', 'Cache lookups by cache and result', ('cache', 'result'))
+ERRORS = Metric('bot_errors_total', 'counter', 'Errors by stage', ('stage',))
+AUDIO_FILES = Metric('bot_audio_files_total', 'counter', 'Downloaded audio files by how they were made playable', ('action',))
+
 # --- Helper Functions ---
 def is_valid_url(text: str) -> bool:
     """Check if the given text is a valid URL."""
     url_pattern = re.compile(r'^https?://\S+$')
     return bool(url_pattern.match(text))
 
+# Query parameters that only track where a link was shared from, on any site (plus utm_*)
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid'])
+
+# Registered domain -> platform; subdomains are matched by stripping labels
+PLATFORM_HOSTS = {
+    'youtube.com': 'YouTube', 'youtu.be': 'YouTube', 'youtube-nocookie.com': 'YouTube',
+    'spotify.com': 'Spotify',
+    'facebook.com': 'Facebook', 'fb.com': 'Facebook', 'fb.watch': 'Facebook',
+    'instagram.com': 'Instagram',
+    'tiktok.com': 'TikTok',
+    'soundcloud.com': 'SoundCloud',
+    'twitter.com': 'Twitter', 'x.com': 'Twitter',
+    'snapchat.com': 'Snapchat',
+    'vimeo.com': 'Vimeo',
+    'reddit.com': 'Reddit', 'redd.it': 'Reddit',
+    'twitch.tv': 'Twitch',
+}
+
+# Per-platform (pattern, kind) rules, tried in order against "host/path?query"
+# with the host's www./m. prefix removed; group 1 is the media ID
+PLATFORM_RULES = {
+    'YouTube': [
+        (re.compile(r'^youtube\.com/playlist\?(?:.*&)?list=([\w-]+)'), 'playlist'),
+        # Auto-generated mixes (RD...) never end, so only the video is taken
+        (re.compile(r'^youtube\.com/watch\?(?:.*&)?list=((?!RD)[\w-]+)'), 'playlist'),
+        (re.compile(r'^youtube\.com/watch\?(?:.*&)?v=([\w-]{11})'), 'single'),
+        (re.compile(r'^(?:youtube|youtube-nocookie)\.com/(?:shorts|embed|live|v)/([\w-]{11})'), 'single'),
+        (re.compile(r'^youtu\.be/([\w-]{11})'), 'single'),
+    ],
+    'Spotify': [
+        (re.compile(r'^open\.spotify\.com/(?:intl-[\w-]+/)?(track|episode)/(\w+)'), 'single'),
+        (re.compile(r'^open\.spotify\.com/(?:intl-[\w-]+/)?album/(\w+)'), 'album'),
+        (re.compile(r'^open\.spotify\.com/(?:intl-[\w-]+/)?playlist/(\w+)'), 'playlist'),
+    ],
+    'SoundCloud': [
+        (re.compile(r'^soundcloud\.com/([\w-]+/sets/[\w-]+)'), 'playlist'),
+        (re.compile(r'^soundcloud\.com/((?!discover|search|charts)[\w-]+/[\w-]+)/?(?:\?|$)'), 'single'),
+    ],
+    'Instagram': [
+        (re.compile(r'^instagram\.com/(?:[\w.]+/)?(?:p|reels?|tv)/([\w-]+)'), 'single'),
+    ],
+    'TikTok': [
+        (re.compile(r'^tiktok\.com/@[\w.-]+/(?:video|photo)/(\d+)'), 'single'),
+        (re.compile(r'^(?:vm|vt)\.tiktok\.com/(\w+)'), 'single'),
+    ],
+    'Twitter': [
+        (re.compile(r'^(?:twitter|x)\.com/(?:\w+|i/web)/status(?:es)?/(\d+)'), 'single'),
+    ],
+    'Facebook': [
+        (re.compile(r'^facebook\.com/(?:watch/?|video\.php)\?(?:.*&)?v=(\d+)'), 'single'),
+        (re.compile(r'^facebook\.com/(?:[\w.-]+/videos/(?:[\w.-]+/)?|reel/)(\d+)'), 'single'),
+        (re.compile(r'^facebook\.com/share/[vr]/(\w+)'), 'single'),
+        (re.compile(r'^fb\.watch/([\w-]+)'), 'single'),
+    ],
+    'Vimeo': [
+        (re.compile(r'^vimeo\.com/(?:channels/[\w-]+/|groups/[\w-]+/videos/|video/)?(\d+)'), 'single'),
+        (re.compile(r'^player\.vimeo\.com/video/(\d+)'), 'single'),
+    ],
+    'Reddit': [
+        (re.compile(r'^reddit\.com/r/\w+/comments/(\w+)'), 'single'),
+        (re.compile(r'^redd\.it/(\w+)'), 'single'),
+    ],
+    'Twitch': [
+        (re.compile(r'^twitch\.tv/videos/(\d+)'), 'single'),
+        (re.compile(r'^(?:clips\.twitch\.tv|twitch\.tv/\w+/clip)/([\w-]+)'), 'single'),
+    ],
+    'Snapchat': [
+        (re.compile(r'^snapchat\.com/(?:spotlight|t)/([\w-]+)'), 'single'),
+    ],
+}
+
+# Per-platform share-tracking parameters; elsewhere names like 's' or 'ref' may be real
+PLATFORM_TRACKING_PARAMS = {
+    'YouTube': frozenset(['si', 'feature', 'pp']),
+    'Spotify': frozenset(['si', 'context', 'nd']),
+    'SoundCloud': frozenset(['si', 'ref']),
+    'Instagram': frozenset(['igshid', 'igsh']),
+    'Facebook': frozenset(['mibextid', 'ref']),
+    'TikTok': frozenset(['is_from_webapp', 'sender_device', 'share_id']),
+    'Twitter': frozenset(['s', 'ref_src', 'ref_url']),
+    'Reddit': frozenset(['share_id', 'ref']),
+}
+
+class MediaRef(NamedTuple):
+    """What a URL points to: platform, canonical media ID (None if unknown) and kind.
+
+    kind is 'single', 'playlist' or 'album'.
+    """
+    platform: str
+    media_id: Optional[str]
+    kind: str
+
 def clean_url(url: str) -> str:
-    """Remove query parameters and fragments from URL."""
-    return re.sub(r'[?#].*$', '', url)
+    """Remove the fragment and tracking parameters from a URL, keeping the ones that identify media."""
+    parsed = urlparse(url.strip())
+    tracking = TRACKING_PARAMS | PLATFORM_TRACKING_PARAMS.get(detect_platform(url), frozenset())
+    query = '&'.join(param for param in parsed.query.split('&')
+                     if param and param.split('=', 1)[0].lower() not in tracking
+                     and not param.lower().startswith('utm_'))
+    return parsed._replace(query=query, fragment='').geturl()
+
+@functools.lru_cache(maxsize=4096)
+def parse_media_url(url: str) -> MediaRef:
+    """Identify the platform, canonical media ID and kind of a URL.
+
+    The host is looked up in PLATFORM_HOSTS (so 'box.com' is not Twitter
+    just because it ends in 'x.com'), then the platform's rules are
+    matched against the rest of the URL.
+    """
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    labels = host.split('.')
+    platform = 'Unknown'
+    for i in range(len(labels) - 1):
+        platform = PLATFORM_HOSTS.get('.'.join(labels[i:]), 'Unknown')
+        if platform != 'Unknown':
+            break
+    if platform == 'Unknown':
+        return MediaRef(platform, None, 'single')
+    
+    for prefix in ('www.', 'm.', 'mobile.', 'music.', 'web.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    target = f"{host}{parsed.path}"
+    if parsed.query:
+        target += f"?{parsed.query}"
+    for pattern, kind in PLATFORM_RULES.get(platform, ()):
+        match = pattern.match(target)
+        if match:
+            # Spotify IDs are only unique per type (track/album/...)
+            media_id = ':'.join(match.groups())
+            return MediaRef(platform, media_id, kind)
+    return MediaRef(platform, None, 'single')
 
 def detect_platform(url: str) -> str:
     """Detect the platform from the URL."""
-    u = url.lower()
-    if 'spotify.com' in u:       return 'Spotify'
-    if 'youtube.com' in u or 'youtu.be' in u: return 'YouTube'
-    if 'facebook.com' in u or 'fb.com' in u:  return 'Facebook'
-    if 'instagram.com' in u:     return 'Instagram'
-    if 'tiktok.com' in u:        return 'TikTok'
-    if 'soundcloud.com' in u:    return 'SoundCloud'
-    if 'twitter.com' in u or 'x.com' in u:    return 'Twitter'
-    if 'snapchat.com' in u:      return 'Snapchat'
-    if 'vimeo.com' in u:         return 'Vimeo'
-    if 'reddit.com' in u:        return 'Reddit'
-    if 'twitch.tv' in u:         return 'Twitch'
-    return 'Unknown'
-
-def is_youtube_playlist(url: str) -> bool:
-    """Check if URL is a YouTube playlist."""
-    return 'youtube.com/playlist' in url.lower() or 'list=' in url.lower()
+    return parse_media_url(url).platform
+
+def get_media_key(url: str) -> Optional[str]:
+    """Get a normalized key identifying the media behind a URL, or None if unknown.
+
+    Used to recognise repeat requests for the same media (e.g. the cache
+    of uploaded Telegram file_ids).
+    """
+    platform, media_id, kind = parse_media_url(url)
+    if media_id:
+        if kind == 'single':
+            return f"{platform.lower()}:{media_id}"
+        return f"{platform.lower()}:{kind}:{media_id}"
+    if platform != 'Unknown':
+        # A known site we can't pin down (e.g. a bare /watch link)
+        return None
+    
+    # Other sites: the address without tracking parameters or fragment
+    parsed = urlparse(clean_url(url))
+    host = (parsed.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    path = parsed.path.rstrip('/')
+    if not host or not path:
+        return None
+    if parsed.query:
+        return f"{host}{path}?{parsed.query}"
+    return f"{host}{path}"
 
 def get_quality_options(platform: str) -> Dict[str, str]:
     """Get quality options based on platform."""
@@ -127,12 +522,13 @@ def get_quality_options(platform: str) -> Dict[str, str]:
             'high': 'High Quality (1080p)',
             'medium': 'Medium Quality (720p)',
             'low': 'Low Quality (480p)',
-            'audio': 'Audio Only (MP3)'
+            'fit': f'Fit to Telegram (≤{MAX_FILE_SIZE_MB}MB)',
+            'audio': 'Audio Only (M4A/MP3)'
         }
     elif platform in ['Instagram', 'TikTok', 'Twitter']:
         return {
             'best': 'Best Quality',
-            'audio': 'Audio Only (MP3)'
+            'audio': 'Audio Only (M4A/MP3)'
         }
     elif platform in ['SoundCloud', 'Spotify']:
         return {
@@ -141,23 +537,179 @@ def get_quality_options(platform: str) -> Dict[str, str]:
     else:
         return {
             'best': 'Best Quality',
-            'audio': 'Audio Only (MP3)'
+            'fit': f'Fit to Telegram (≤{MAX_FILE_SIZE_MB}MB)',
+            'audio': 'Audio Only (M4A/MP3)'
         }
 
-def get_ydl_opts(url: str, quality: str = 'best') -> Tuple[Dict[str, Any], bool]:
+def estimate_format_size(fmt: Dict[str, Any], duration: Optional[float]) -> Optional[float]:
+    """Estimate a format's size in bytes from its reported size or bitrate."""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if not size and fmt.get('tbr') and duration:
+        size = fmt['tbr'] * 1000 / 8 * duration
+    return size
+
+def estimate_quality(info: Dict[str, Any], quality: str) -> Optional[Tuple[int, Optional[float]]]:
+    """Estimate (height, size) of what a quality option would download, or None if unavailable."""
+    formats = info.get('formats') or []
+    duration = info.get('duration')
+    audio_formats = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    best_audio = max(audio_formats, key=lambda f: f.get('abr') or f.get('tbr') or 0, default=None)
+    best_audio_size = estimate_format_size(best_audio, duration) if best_audio else None
+    
+    if quality == 'audio':
+        return (0, best_audio_size) if best_audio else None
+    
+    limit = QUALITY_HEIGHTS.get(quality)
+    video_formats = [f for f in formats if f.get('vcodec') not in (None, 'none') and f.get('height')
+                     and (limit is None or f['height'] <= limit)]
+    if not video_formats:
+        return None
+    best_video = max(video_formats, key=lambda f: (f['height'], f.get('tbr') or 0))
+    size = estimate_format_size(best_video, duration)
+    if size and best_video.get('acodec') == 'none':
+        size += best_audio_size or 0
+    return best_video['height'], size
+
+def is_playable_codec(fmt: Dict[str, Any], kind: str) -> bool:
+    """Check if a format's video or audio codec (kind 'vcodec'/'acodec') plays in Telegram."""
+    codec = (fmt.get(kind) or '').lower()
+    if kind == 'vcodec':
+        return codec.startswith(('avc', 'h264', 'hev', 'hvc', 'h265'))
+    return codec.startswith(('mp4a', 'aac', 'mp3'))
+
+def select_fit_format(info: Dict[str, Any], max_size: int) -> Optional[Tuple[str, int, float]]:
+    """Pick the best format (or video+audio pair) expected to fit in max_size bytes.
+
+    Sizes come from filesize, filesize_approx or tbr x duration; formats
+    without any size information are skipped. At equal height, H.264 with
+    AAC is preferred like VIDEO_FORMAT_SORT does. Returns (format_spec,
+    height, estimated_size), or None if nothing fits.
+    """
+    formats = info.get('formats') or []
+    duration = info.get('duration')
+    budget = max_size * FIT_SIZE_MARGIN
+    
+    candidates = []
+    audio_formats = []
+    for fmt in formats:
+        size = estimate_format_size(fmt, duration)
+        if not size:
+            continue
+        has_video = fmt.get('vcodec') not in (None, 'none') and fmt.get('height')
+        has_audio = fmt.get('acodec') not in (None, 'none')
+        if has_video and has_audio:
+            playable = is_playable_codec(fmt, 'vcodec') + is_playable_codec(fmt, 'acodec')
+            candidates.append((fmt['format_id'], fmt['height'], playable, fmt.get('tbr') or 0, size))
+        elif has_audio and fmt.get('vcodec') == 'none':
+            audio_formats.append(fmt)
+    
+    # Pair each video-only format with the best audio that still fits, AAC/MP3 first
+    audio_formats.sort(key=lambda f: (is_playable_codec(f, 'acodec'), f.get('abr') or f.get('tbr') or 0),
+                       reverse=True)
+    for fmt in formats:
+        if fmt.get('vcodec') in (None, 'none') or not fmt.get('height') or fmt.get('acodec') != 'none':
+            continue
+        video_size = estimate_format_size(fmt, duration)
+        if not video_size:
+            continue
+        for audio in audio_formats:
+            audio_size = estimate_format_size(audio, duration)
+            if video_size + audio_size <= budget:
+                playable = is_playable_codec(fmt, 'vcodec') + is_playable_codec(audio, 'acodec')
+                candidates.append((f"{fmt['format_id']}+{audio['format_id']}", fmt['height'], playable,
+                                   (fmt.get('tbr') or 0) + (audio.get('tbr') or 0), video_size + audio_size))
+                break
+    
+    fitting = [c for c in candidates if c[4] <= budget]
+    if not fitting:
+        return None
+    spec, height, _, _, size = max(fitting, key=lambda c: (c[1], c[2], c[3]))
+    return spec, height, size
+
+def get_probed_quality_options(platform: str, info: Optional[Dict[str, Any]]) -> Tuple[Dict[str, str], float]:
+    """Get quality options that actually exist for probed media, labelled with estimated sizes.
+
+    Options whose estimate exceeds MAX_DOWNLOAD_SIZE are left out. Returns
+    (options, largest estimated size); without format info the static
+    platform options are returned.
+    """
+    options = get_quality_options(platform)
+    if not info or not info.get('formats'):
+        return options, 0
+    
+    probed = {}
+    heights = set()
+    largest = 0
+    for quality, label in options.items():
+        if quality == 'fit':
+            fit = select_fit_format(info, MAX_FILE_SIZE)
+            if fit:
+                probed[quality] = f"{label.split(' (')[0]} ({fit[1]}p) ~{format_size(fit[2])}"
+            elif FIT_REENCODE:
+                probed[quality] = label
+            continue
+        
+        estimate = estimate_quality(info, quality)
+        if quality in QUALITY_HEIGHTS:
+            # Skip tiers that don't exist or would give the same file as a higher one
+            if not estimate or estimate[0] in heights:
+                continue
+            heights.add(estimate[0])
+            label = f"{label.split(' (')[0]} ({estimate[0]}p)"
+        if estimate and estimate[1]:
+            if estimate[1] > MAX_DOWNLOAD_SIZE:
+                continue
+            largest = max(largest, estimate[1])
+            label += f" ~{format_size(estimate[1])}"
+        probed[quality] = label
+    return probed, largest
+
+def is_audio_request(url: str, quality: str) -> bool:
+    """Check if a request downloads audio only."""
+    return is_audio_quality(detect_platform(url), quality)
+
+def is_audio_quality(platform: str, quality: str) -> bool:
+    """Check if a quality option of a platform downloads audio only."""
+    return quality == 'audio' or platform in ['SoundCloud', 'Spotify']
+
+@functools.lru_cache(maxsize=None)
+def use_aria2c() -> bool:
+    """Check if progressive downloads go through aria2c (configured and installed)."""
+    return EXTERNAL_DOWNLOADER == 'aria2c' and shutil.which('aria2c') is not None
+
+def get_aria2c_args(ratelimit: Optional[int] = None) -> List[str]:
+    """Get the aria2c arguments for a download, capped at ratelimit bytes/s if given."""
+    args = ['-x', str(ARIA2C_CONNECTIONS), '-s', str(ARIA2C_CONNECTIONS), '-k', '1M']
+    if ratelimit:
+        args += ['--max-download-limit', str(ratelimit)]
+    return args
+
+def get_ydl_opts(url: str, quality: str = 'best', output_dir: str = DOWNLOAD_DIR) -> Tuple[Dict[str, Any], bool]:
     """Get yt-dlp options based on URL and quality."""
-    platform = detect_platform(url)
-    is_audio = quality == 'audio' or platform in ['SoundCloud', 'Spotify']
+    opts, is_audio = get_ydl_opts_for(detect_platform(url), quality, output_dir)
+    opts['noplaylist'] = not is_collection_url(url)  # Don't expand mixes behind single links
+    return opts, is_audio
+
+def get_ydl_opts_for(platform: str, quality: str = 'best',
+                     output_dir: str = DOWNLOAD_DIR) -> Tuple[Dict[str, Any], bool]:
+    """Get yt-dlp options for a platform and quality.
+
+    They depend on nothing else, so URLs sharing a pooled YoutubeDL (see
+    pooled_ydl) always get the same options.
+    """
+    is_audio = is_audio_quality(platform, quality)
     
     common = {
-        'outtmpl': os.path.join(DOWNLOAD_DIR, '%(title)s.%(ext)s'),
+        'outtmpl': os.path.join(output_dir, '%(title)s.%(ext)s'),
         'quiet': False,  # Enable verbose output for debugging
         'verbose': True, # More verbose for troubleshooting
         'no_warnings': False,
         'socket_timeout': 120,  # Increased timeout
         'nocheckcertificate': True,
         'ignoreerrors': False,  # Don't ignore errors to see what's happening
-        'noplaylist': False,    # Allow downloading playlists
+        'noplaylist': True,
+        'concurrent_fragment_downloads': CONCURRENT_FRAGMENTS,
+        'http_chunk_size': HTTP_CHUNK_SIZE or None,
         'http_headers': {
             'User-Agent': (
                 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
@@ -174,7 +726,7 @@ def get_ydl_opts(url: str, quality: str = 'best') -> Tuple[Dict[str, Any], bool]
     }
     
     # Platform-specific settings
-    if 'tiktok.com' in url.lower():
+    if platform == 'TikTok':
         # Special TikTok settings to bypass restrictions
         common['http_headers'].update({
             'Referer': 'https://www.tiktok.com/',
@@ -190,8 +742,15 @@ def get_ydl_opts(url: str, quality: str = 'best') -> Tuple[Dict[str, Any], bool]
             }
         })
     
+    if use_aria2c():
+        # Only progressive HTTP files; fragmented formats keep the native downloader
+        common.update({
+            'external_downloader': {'http': 'aria2c'},
+            'external_downloader_args': {'aria2c': get_aria2c_args()},
+        })
+    
     # YouTube-specific options
-    if 'youtube.com' in url.lower() or 'youtu.be' in url.lower():
+    if platform == 'YouTube':
         # Add additional YouTube-specific options
         common.update({
             'extract_flat': 'in_playlist',
@@ -202,14 +761,10 @@ def get_ydl_opts(url: str, quality: str = 'best') -> Tuple[Dict[str, Any], bool]
     
     # Quality settings
     if is_audio:
+        # Prefer codecs Telegram plays, so prepare_audio has nothing to transcode
         return {
             **common,
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
+            'format': 'bestaudio[acodec^=mp4a]/bestaudio[acodec=mp3]/bestaudio/best',
         }, True
     else:
         format_str = 'bestvideo+bestaudio/best'
@@ -217,92 +772,269 @@ def get_ydl_opts(url: str, quality: str = 'best') -> Tuple[Dict[str, Any], bool]
             format_str = 'bestvideo[height<=1080]+bestaudio/best[height<=1080]/best'
         elif quality == 'medium':
             format_str = 'bestvideo[height<=720]+bestaudio/best[height<=720]/best'
-        elif quality == 'low':
+        elif quality == 'low' or quality == 'fit':
+            # 'fit' normally gets an exact format from select_fit_format;
+            # this is the starting point when nothing fits and we re-encode
             format_str = 'bestvideo[height<=480]+bestaudio/best[height<=480]/best'
         
         return {
             **common,
             'format': format_str,
-            'merge_output_format': 'mp4'
+            'format_sort': VIDEO_FORMAT_SORT,
+            'merge_output_format': 'mp4',
+            # Put the index first so Telegram can stream the merged file
+            'postprocessor_args': {'merger': ['-movflags', '+faststart']},
         }, False
 
-def download_media(url: str, quality: str = 'best') -> List[Tuple[str, bool]]:
-    """Download media using yt-dlp."""
-    opts, is_audio = get_ydl_opts(url, quality)
+# Options of metadata-only extraction
+PROBE_OPTS = {'quiet': True, 'verbose': False, 'noplaylist': True, 'skip_download': True}
+
+# Warm YoutubeDL instances of each thread, see pooled_ydl
+_ydl_local = threading.local()
+
+def _hook_dispatcher(hooks: Dict[str, Callable], name: str) -> Callable:
+    """Get a yt-dlp hook that forwards to whichever job hook is currently set."""
+    def dispatch(d):
+        hook = hooks.get(name)
+        if hook:
+            hook(d)
+    return dispatch
+
+@contextlib.contextmanager
+def pooled_ydl(url: str, quality: str = 'best', job_dir: str = DOWNLOAD_DIR,
+               progress_hook: Optional[Callable] = None,
+               postprocessor_hook: Optional[Callable] = None,
+               format_spec: Optional[str] = None,
+               aria2c_ratelimit: Optional[int] = None,
+               extra_opts: Optional[Dict[str, Any]] = None) -> Iterator[yt_dlp.YoutubeDL]:
+    """Borrow this thread's warm YoutubeDL for the URL's platform and quality.
+
+    Instances are kept per thread (one job runs on a thread at a time) and
+    keep their extractors, cookies and HTTP connections between jobs. The
+    output directory, playlist handling, format, aria2c rate limit and
+    hooks are set for this job only.
+    """
+    platform = detect_platform(url)
+    opts, _ = get_ydl_opts_for(platform, quality, job_dir)
+    opts['noplaylist'] = not is_collection_url(url)
+    opts.update(extra_opts or {})
+    if YDL_POOL_SIZE <= 0:
+        opts['progress_hooks'] = [progress_hook] if progress_hook else []
+        opts['postprocessor_hooks'] = [postprocessor_hook] if postprocessor_hook else []
+        if use_aria2c():
+            opts['external_downloader_args'] = {'aria2c': get_aria2c_args(aria2c_ratelimit)}
+        if format_spec:
+            opts['format'] = format_spec
+        with yt_dlp.YoutubeDL(opts) as ydl:
+            yield ydl
+        return
+    
+    pool = getattr(_ydl_local, 'pool', None)
+    if pool is None:
+        # profile -> (ydl, hooks, created_at), least recently used first
+        pool = _ydl_local.pool = OrderedDict()
+    profile = (platform, quality, tuple(sorted((extra_opts or {}).items())))
+    entry = pool.pop(profile, None)
+    if entry and time.monotonic() - entry[2] > YDL_MAX_AGE:
+        entry[0].close()
+        entry = None
+    if entry:
+        CACHE_LOOKUPS.inc(cache='ydl', result='hit')
+    else:
+        CACHE_LOOKUPS.inc(cache='ydl', result='miss')
+        hooks: Dict[str, Callable] = {}
+        ydl = yt_dlp.YoutubeDL({
+            **opts,
+            'progress_hooks': [_hook_dispatcher(hooks, 'progress')],
+            'postprocessor_hooks': [_hook_dispatcher(hooks, 'postprocessor')],
+        })
+        entry = (ydl, hooks, time.monotonic())
+    
+    ydl, hooks, _ = entry
+    params = ydl.params
+    saved = (params.get('format'), ydl.format_selector)
+    params['outtmpl']['default'] = opts['outtmpl']
+    params['noplaylist'] = opts['noplaylist']
+    if use_aria2c():
+        params['external_downloader_args'] = {'aria2c': get_aria2c_args(aria2c_ratelimit)}
+    if format_spec:
+        params['format'] = format_spec
+        ydl.format_selector = ydl.build_format_selector(format_spec)
+    hooks['progress'] = progress_hook
+    hooks['postprocessor'] = postprocessor_hook
+    try:
+        yield ydl
+    finally:
+        hooks.clear()
+        params['format'], ydl.format_selector = saved
+        if profile in pool:
+            # A nested job on this thread already returned an instance for the profile
+            ydl.close()
+        else:
+            pool[profile] = entry
+        while len(pool) > YDL_POOL_SIZE:
+            _, (old, _, _) = pool.popitem(last=False)
+            old.close()
+
+MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.mp3', '.m4a', '.wav', '.webm')
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.wav')
+
+def get_job_dir(job_id: int) -> str:
+    """Get the working directory of a download job.
+
+    It is named after the job's row in the jobs table, so a job resumed
+    after a restart finds its partial downloads again.
+    """
+    return os.path.join(DOWNLOAD_DIR, f"job_{job_id}")
+
+def remove_job_dir(job_dir: str):
+    """Remove a job's working directory and everything in it."""
+    try:
+        shutil.rmtree(job_dir)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.error(f"Error removing job directory {job_dir}: {e}")
+
+def scan_job_dir(job_dir: str, is_audio: bool) -> List[Tuple[str, bool]]:
+    """List the media files inside a job directory."""
+    files = []
+    for fname in sorted(os.listdir(job_dir)):
+        if fname.lower().endswith(MEDIA_EXTENSIONS):
+            is_audio_file = fname.lower().endswith(AUDIO_EXTENSIONS)
+            files.append((os.path.join(job_dir, fname), is_audio_file or is_audio))
+    return files
+
+def get_downloaded_paths(info: Dict[str, Any]) -> List[str]:
+    """Get the final file paths yt-dlp reports for an extracted info dict.
+
+    yt-dlp records every downloaded (and post-processed) file in the
+    'requested_downloads' list of each entry, so no directory scan is needed.
+    """
+    if info.get('_type') == 'playlist' or 'entries' in info:
+        paths = []
+        for entry in info.get('entries') or []:
+            if entry:
+                paths.extend(get_downloaded_paths(entry))
+        return paths
+    
+    paths = []
+    for download in info.get('requested_downloads') or []:
+        path = download.get('filepath') or download.get('_filename')
+        if path and path not in paths:
+            paths.append(path)
+    if not paths and info.get('filepath'):
+        paths.append(info['filepath'])
+    return [path for path in paths if os.path.exists(path)]
+
+def probe_media(url: str) -> Optional[Dict[str, Any]]:
+    """Extract media metadata (formats, duration, sizes) without downloading anything."""
+    with pooled_ydl(url, extra_opts=PROBE_OPTS) as ydl:
+        info = ydl.extract_info(url, download=False)
+    if not info or info.get('_type') == 'playlist':
+        return None
+    # Plain data only, so the info can be cached and handed to worker processes
+    return yt_dlp.YoutubeDL.sanitize_info(info)
+
+def get_cached_media_info(url: str) -> Optional[Dict[str, Any]]:
+    """Get probed metadata for a URL if it is cached and still fresh."""
+    cached = _media_info_cache.get(url)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+async def get_media_info(url: str) -> Optional[Dict[str, Any]]:
+    """Get metadata for a URL, probing it off the event loop unless cached.
+
+    Probes use the loop's default thread pool so they don't queue behind
+    running downloads, and concurrent requests for the same link share a
+    single probe. Returns None if the URL couldn't be probed.
+    """
+    info = get_cached_media_info(url)
+    if info:
+        CACHE_LOOKUPS.inc(cache='probe', result='hit')
+        return info
+    CACHE_LOOKUPS.inc(cache='probe', result='miss')
+    
+    key = clean_url(url)
+    lookup = _media_info_lookups.get(key)
+    if lookup is None:
+        lookup = asyncio.ensure_future(fetch_media_info(url))
+        _media_info_lookups[key] = lookup
+        lookup.add_done_callback(lambda _: _media_info_lookups.pop(key, None))
+    return await asyncio.shield(lookup)
+
+async def fetch_media_info(url: str) -> Optional[Dict[str, Any]]:
+    """Probe a URL in the default thread pool and cache its metadata."""
+    loop = asyncio.get_running_loop()
+    try:
+        with time_stage('probe', detect_platform(url)):
+            info = await loop.run_in_executor(None, probe_media, url)
+    except Exception as e:
+        logger.warning(f"Probe failed for {url}: {e}")
+        ERRORS.inc(stage='probe')
+        return None
+    
+    if info:
+        _media_info_cache[url] = (info, time.monotonic() + PROBE_CACHE_TTL)
+        _media_info_cache.move_to_end(url)
+        while len(_media_info_cache) > PROBE_CACHE_MAX:
+            _media_info_cache.popitem(last=False)
+    return info
+
+def download_media(url: str, quality: str = 'best', job_dir: str = DOWNLOAD_DIR,
+                   progress_hook: Optional[Callable] = None,
+                   info: Optional[Dict[str, Any]] = None) -> List[Tuple[str, bool]]:
+    """Download media using yt-dlp into the given job directory.
+
+    If info from an earlier probe is given it is processed directly
+    instead of extracting the URL a second time.
+    """
+    is_audio = is_audio_request(url, quality)
+    format_spec = None
+    if quality == 'fit':
+        # Choose formats by size so the result needs no splitting
+        if info is None:
+            info = probe_media(url)
+        fit = select_fit_format(info, MAX_FILE_SIZE) if info else None
+        if fit:
+            format_spec = fit[0]
+            logger.info(f"Fit to Telegram: using format {fit[0]} (~{format_size(fit[2])})")
     logger.info(f"Starting download with yt-dlp for URL: {url}, quality: {quality}")
     
     try:
-        # Clean the download directory first to avoid confusion with existing files
-        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        os.makedirs(job_dir, exist_ok=True)
         
-        with yt_dlp.YoutubeDL(opts) as ydl:
+        # aria2c can't be throttled from hooks; it gets a fixed share instead
+        ratelimit = bandwidth.fair_share() if use_aria2c() else None
+        with bandwidth.job() as throttle, \
+                pooled_ydl(url, quality, job_dir, chain_hooks(throttle, progress_hook),
+                           get_postprocessor_timer(), format_spec, ratelimit) as ydl:
             try:
-                info = ydl.extract_info(url, download=True)
+                if info:
+                    info = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                else:
+                    info = ydl.extract_info(url, download=True)
                 if not info:
                     logger.error("No information extracted from URL")
                     return []
                 
-                # Handle single video or playlist
-                entries = []
-                if 'entries' in info:
-                    # It's a playlist
-                    entries = [entry for entry in info['entries'] if entry]
-                    logger.info(f"Found playlist with {len(entries)} items")
-                else:
-                    # It's a single video
-                    entries = [info]
-                    logger.info("Found single video")
-                
-                files = []
-                for entry in entries:
-                    if entry is None:
-                        continue
-                    
-                    # Get the prepared filename
-                    if isinstance(entry, dict):
-                        filename = None
-                        
-                        # Try to get the filename using different methods
-                        try:
-                            # Method 1: Use prepare_filename if id and ext are available
-                            if 'id' in entry and 'ext' in entry:
-                                path = ydl.prepare_filename(entry)
-                                filename = path
-                        except Exception as e:
-                            logger.error(f"Error preparing filename: {str(e)}")
-                        
-                        # Method 2: Check if the file was already saved
-                        if not filename or not os.path.exists(filename):
-                            if 'title' in entry:
-                                # Look for files with similar names in the download directory
-                                title = entry['title']
-                                for fname in os.listdir(DOWNLOAD_DIR):
-                                    if title.lower() in fname.lower():
-                                        filename = os.path.join(DOWNLOAD_DIR, fname)
-                                        break
-                        
-                        # Process the file if found
-                        if filename and os.path.exists(filename):
-                            # For audio downloads, check if MP3 conversion worked
-                            if is_audio and not filename.endswith('.mp3'):
-                                mp3_path = os.path.splitext(filename)[0] + '.mp3'
-                                if os.path.exists(mp3_path):
-                                    filename = mp3_path
-                            
-                            files.append((filename, is_audio))
-                            logger.info(f"Added file to results: {filename}")
+                files = [(path, is_audio or path.lower().endswith(AUDIO_EXTENSIONS))
+                         for path in get_downloaded_paths(info)]
+                for path, _ in files:
+                    logger.info(f"Added file to results: {path}")
                 
-                # If no files were found using the above methods, look for any new media files
+                # The job directory only holds this job's files, so scanning it is safe
                 if not files:
-                    logger.info("No files found through direct methods, scanning directory...")
-                    # Look for media files in the download directory
-                    for fname in os.listdir(DOWNLOAD_DIR):
-                        if fname.lower().endswith(('.mp4', '.mkv', '.mp3', '.m4a', '.wav', '.webm')):
-                            path = os.path.join(DOWNLOAD_DIR, fname)
-                            # Determine if it's audio based on extension
-                            is_audio_file = fname.lower().endswith(('.mp3', '.m4a', '.wav'))
-                            files.append((path, is_audio_file or is_audio))
-                            logger.info(f"Found media file: {path}")
+                    logger.info("No file paths reported by yt-dlp, scanning job directory...")
+                    files = scan_job_dir(job_dir, is_audio)
+                
+                if is_audio:
+                    files = [(prepare_audio(path), True) for path, _ in files]
+                
+                if quality == 'fit' and FIT_REENCODE:
+                    files = [(path if file_is_audio else reencode_to_fit(path, (info or {}).get('duration')), file_is_audio)
+                             for path, file_is_audio in files]
                 
                 return files
                 
@@ -313,123 +1045,1147 @@ def download_media(url: str, quality: str = 'best') -> List[Tuple[str, bool]]:
         logger.error(f"Error in download_media: {str(e)}")
         raise Exception(f"Failed to download: {str(e)}")
 
-def download_spotify(url: str) -> List[Tuple[str, bool]]:
-    """Download Spotify tracks using spotdl."""
+def chain_hooks(*hooks: Optional[Callable]) -> Optional[Callable]:
+    """Combine yt-dlp hooks into one, skipping missing ones."""
+    hooks = [hook for hook in hooks if hook]
+    if len(hooks) <= 1:
+        return hooks[0] if hooks else None
+    
+    def hook(d):
+        for h in hooks:
+            h(d)
+    return hook
+
+def get_postprocessor_timer() -> Callable:
+    """Get a yt-dlp postprocessor hook that times merges and conversions as request stages."""
+    started: Dict[str, float] = {}
+    
+    def hook(d):
+        name = d.get('postprocessor', '')
+        if d.get('status') == 'started':
+            started[name] = time.monotonic()
+        elif d.get('status') == 'finished' and name in started:
+            stage = 'merge' if name == 'Merger' else 'convert'
+            STAGE_SECONDS.observe(time.monotonic() - started.pop(name), stage=stage, platform=current_platform.get())
+    return hook
+
+# Limits the ffmpeg encodes running at once in this process
+_ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_MAX_PROCS)
+
+def run_ffmpeg(cmd: List[str], stage: str) -> float:
+    """Run an ffmpeg command on the encode pool, timing it as a request stage.
+
+    At most FFMPEG_MAX_PROCS run at once, each limited to FFMPEG_THREADS
+    threads at FFMPEG_NICE niceness, so encodes can't starve downloads and
+    uploads of CPU. The last element of cmd must be the output file.
+    Returns the seconds ffmpeg ran (not counting the wait for a slot).
+    """
+    cmd = cmd[:-1] + ['-threads', str(FFMPEG_THREADS), cmd[-1]]
+    if shutil.which('nice'):
+        cmd = ['nice', '-n', str(FFMPEG_NICE)] + cmd
+    with _ffmpeg_slots:
+        start = time.monotonic()
+        with time_stage(stage):
+            subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return time.monotonic() - start
+
+# Audio codecs Telegram plays, with the container they are sent in
+PLAYABLE_AUDIO = {'mp3': '.mp3', 'aac': '.m4a'}
+
+def probe_streams(file_path: str) -> List[Tuple[str, str]]:
+    """List the (codec_type, codec_name) of each stream in a media file."""
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'stream=codec_type,codec_name',
+           '-of', 'csv=p=0:nk=1', file_path]
+    output = subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode()
+    streams = []
+    for line in output.splitlines():
+        codec_name, _, codec_type = line.strip().partition(',')
+        if codec_type:
+            streams.append((codec_type, codec_name))
+    return streams
+
+def prepare_audio(file_path: str) -> str:
+    """Make a downloaded audio file playable in Telegram; returns the path to send.
+
+    MP3 and AAC are kept as they are, or remuxed into .mp3/.m4a if they
+    came in another container or with a video track. Only other codecs
+    (Opus, Vorbis, ...) are transcoded to MP3. If ffmpeg fails the file is
+    sent as downloaded.
+    """
+    try:
+        streams = probe_streams(file_path)
+        codec = next((name for kind, name in streams if kind == 'audio'), None)
+        has_video = any(kind == 'video' for kind, _ in streams)
+        base_name, ext = os.path.splitext(file_path)
+        target_ext = PLAYABLE_AUDIO.get(codec)
+        if target_ext and ext.lower() == target_ext and not has_video:
+            AUDIO_FILES.inc(action='passthrough')
+            return file_path
+        
+        output_path = base_name + (target_ext or '.mp3')
+        if output_path == file_path:
+            output_path = f"{base_name}_audio{target_ext}"
+        if target_ext:
+            cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path, '-vn', '-c:a', 'copy']
+            if target_ext == '.m4a':
+                cmd += ['-movflags', '+faststart']
+            action = 'remux'
+        else:
+            cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path, '-vn',
+                   '-c:a', 'libmp3lame', '-b:a', AUDIO_BITRATE]
+            action = 'transcode'
+        elapsed = run_ffmpeg(cmd + [output_path], action)
+        os.remove(file_path)
+        AUDIO_FILES.inc(action=action)
+        logger.info(f"Audio {action} of {os.path.basename(file_path)} ({codec}) took {elapsed:.1f}s")
+        return output_path
+    except Exception as e:
+        logger.error(f"Preparing audio {file_path} failed: {e}")
+        ERRORS.inc(stage='audio')
+        return file_path
+
+# Video codecs Telegram clients play inline when sent in an MP4
+PLAYABLE_VIDEO_CODECS = ('h264', 'hevc')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv', '.webm')
+
+def probe_video(file_path: str) -> Dict[str, Any]:
+    """Get the codecs, dimensions and duration of a video in one ffprobe pass."""
+    cmd = ['ffprobe', '-v', 'error', '-show_entries',
+           'stream=codec_type,codec_name,width,height:format=duration', '-of', 'json', file_path]
+    probe = json.loads(subprocess.check_output(cmd, stderr=subprocess.DEVNULL))
+    video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), {})
+    audio = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'audio'), {})
+    return {
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name'),
+        'width': video.get('width'),
+        'height': video.get('height'),
+        'duration': float(probe.get('format', {}).get('duration') or 0),
+    }
+
+def is_faststart(file_path: str) -> bool:
+    """Check if an MP4's index (moov box) comes before its media data, so it plays while loading."""
+    with open(file_path, 'rb') as f:
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            size, box_type = struct.unpack('>I4s', header)
+            if box_type == b'moov':
+                return True
+            if box_type == b'mdat':
+                return False
+            if size == 1:
+                # 64-bit box size follows the header
+                size = struct.unpack('>Q', f.read(8))[0] - 8
+            elif size == 0:
+                # Box runs to the end of the file
+                return False
+            f.seek(size - 8, os.SEEK_CUR)
+
+def prepare_video(file_path: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+    """Decide how a video is sent before uploading it.
+
+    Returns the path to upload and the send_video arguments (duration,
+    width, height, supports_streaming), or None if it should go out as a
+    document because Telegram can't play it. Playable videos that aren't
+    an MP4 with the index first are remuxed into a temporary copy (with
+    Opus or other audio transcoded to AAC), so the caller must remove the
+    returned path if it differs from file_path.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
     try:
-        cmd = ['spotdl', url, '--output', DOWNLOAD_DIR]
+        meta = probe_video(file_path)
+    except Exception as e:
+        logger.warning(f"Could not probe {file_path}: {e}")
+        # Without ffprobe, trust the extension
+        return file_path, ({} if ext == '.mp4' else None)
+    
+    if meta['video_codec'] not in PLAYABLE_VIDEO_CODECS:
+        logger.info(f"{os.path.basename(file_path)} ({meta['video_codec']}/{meta['audio_codec']}) "
+                    f"is not playable in Telegram, sending it as a document")
+        return file_path, None
+    
+    video = {
+        'duration': round(meta['duration']) or None,
+        'width': meta['width'],
+        'height': meta['height'],
+        'supports_streaming': True,
+    }
+    audio_playable = meta['audio_codec'] in (None, 'aac', 'mp3')
+    if audio_playable and ext == '.mp4' and is_faststart(file_path):
+        return file_path, video
+    
+    stream_dir = os.path.join(os.path.dirname(file_path), 'stream')
+    os.makedirs(stream_dir, exist_ok=True)
+    upload_path = os.path.join(stream_dir, os.path.splitext(os.path.basename(file_path))[0] + '.mp4')
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path,
+           '-map', '0:v:0', '-map', '0:a:0?', '-c', 'copy']
+    if not audio_playable:
+        cmd += ['-c:a', 'aac', '-b:a', AUDIO_BITRATE]
+    cmd += ['-movflags', '+faststart', upload_path]
+    try:
+        run_ffmpeg(cmd, 'remux' if audio_playable else 'transcode')
+        if os.path.getsize(upload_path) <= MAX_FILE_SIZE:
+            return upload_path, video
+        logger.warning(f"Remuxed {upload_path} is over the size limit, sending the original")
+    except Exception as e:
+        logger.error(f"Faststart remux of {file_path} failed: {e}")
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+    if not audio_playable:
+        logger.info(f"{os.path.basename(file_path)} keeps its {meta['audio_codec']} audio, sending it as a document")
+        return file_path, None
+    # An MP4 with the index at the end still plays, just not while loading
+    return file_path, (dict(video, supports_streaming=False) if ext == '.mp4' else None)
+
+def reencode_to_fit(file_path: str, duration: Optional[float] = None) -> str:
+    """Re-encode a video that is over MAX_FILE_SIZE to a bitrate that fits; returns the path to send.
+
+    Returns the original path if it already fits, is too long to fit at a
+    watchable bitrate, or if ffmpeg fails (it will then be split as usual).
+    """
+    if os.path.getsize(file_path) <= MAX_FILE_SIZE:
+        return file_path
+    try:
+        if not duration:
+            duration_cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+                            '-of', 'default=noprint_wrappers=1:nokey=1', file_path]
+            duration = float(subprocess.check_output(duration_cmd).decode().strip())
+        
+        audio_bitrate = 96_000
+        video_bitrate = int(MAX_FILE_SIZE * 8 * FIT_SIZE_MARGIN / duration) - audio_bitrate
+        if video_bitrate < FIT_MIN_VIDEO_BITRATE:
+            logger.info(f"{file_path} is too long to re-encode under the limit, it will be split")
+            return file_path
+        
+        output_path = os.path.splitext(file_path)[0] + '_fit.mp4'
+        cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path,
+               '-c:v', 'libx264', '-preset', 'veryfast',
+               '-b:v', str(video_bitrate), '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2),
+               '-c:a', 'aac', '-b:a', str(audio_bitrate),
+               '-movflags', '+faststart', output_path]
+        run_ffmpeg(cmd, 'reencode')
+        os.remove(file_path)
+        logger.info(f"Re-encoded {file_path} at {video_bitrate // 1000}kbps to fit Telegram")
+        return output_path
+    except Exception as e:
+        logger.error(f"Re-encoding {file_path} failed: {e}")
+        return file_path
+
+def download_spotify(url: str, job_dir: str = DOWNLOAD_DIR) -> List[Tuple[str, bool]]:
+    """Download Spotify tracks using spotdl into the given job directory."""
+    try:
+        os.makedirs(job_dir, exist_ok=True)
+        cmd = ['spotdl', url, '--output', job_dir, '--format', SPOTDL_FORMAT]
+        if SPOTDL_FORMAT == 'm4a':
+            # Keep the source stream instead of re-encoding it
+            cmd += ['--bitrate', 'disable']
         subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         
-        files = []
-        for fname in os.listdir(DOWNLOAD_DIR):
-            if fname.lower().endswith(('.mp3', '.m4a')):
-                files.append((os.path.join(DOWNLOAD_DIR, fname), True))
-        return files
+        return [(path, True) for path, _ in scan_job_dir(job_dir, True)
+                if path.lower().endswith(('.mp3', '.m4a'))]
     except subprocess.CalledProcessError as e:
         logger.error(f"spotdl error: {e}")
         logger.error(f"stdout: {e.stdout.decode() if e.stdout else 'None'}")
         logger.error(f"stderr: {e.stderr.decode() if e.stderr else 'None'}")
         raise Exception("Failed to download from Spotify. Make sure spotdl is installed and working properly.")
 
-def split_large_file(file_path: str) -> List[str]:
-    """Split large files into smaller chunks for Telegram."""
+def is_collection_url(url: str) -> bool:
+    """Check if URL points to a playlist or album rather than a single item."""
+    return parse_media_url(url).kind != 'single'
+
+def iter_collection_entries(url: str, job_dir: str) -> Iterator[str]:
+    """Yield the URL of each item in a playlist or album, fetching the listing lazily."""
+    if detect_platform(url) == 'Spotify':
+        yield from list_spotify_tracks(url, job_dir)
+        return
+    
+    opts, _ = get_ydl_opts(url, 'best', job_dir)
+    opts['extract_flat'] = 'in_playlist'
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        # process=False keeps 'entries' lazy, so pages are only fetched as needed
+        info = ydl.extract_info(url, download=False, process=False)
+        if not info:
+            return
+        if 'entries' not in info:
+            yield info.get('webpage_url') or url
+            return
+        for entry in info['entries']:
+            if not entry:
+                continue
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if entry_url:
+                yield entry_url
+
+def list_spotify_tracks(url: str, job_dir: str) -> List[str]:
+    """List the track URLs of a Spotify album or playlist using spotdl."""
+    save_file = os.path.join(job_dir, 'tracks.spotdl')
+    try:
+        cmd = ['spotdl', 'save', url, '--save-file', save_file]
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        with open(save_file, 'r') as f:
+            songs = json.load(f)
+        return [song['url'] for song in songs if song.get('url')]
+    except subprocess.CalledProcessError as e:
+        logger.error(f"spotdl error: {e}")
+        logger.error(f"stderr: {e.stderr.decode() if e.stderr else 'None'}")
+        raise Exception("Failed to list Spotify tracks. Make sure spotdl is installed and working properly.")
+
+def download_item(url: str, quality: str, job_dir: str,
+                  progress_hook: Optional[Callable] = None,
+                  info: Optional[Dict[str, Any]] = None) -> List[Tuple[str, bool]]:
+    """Download a single item with the downloader suited to its platform."""
+    if detect_platform(url) == 'Spotify':
+        return download_spotify(url, job_dir)
+    return download_media(url, quality, job_dir, progress_hook, info)
+
+def copy_file_part(src, dst, offset: int, length: int):
+    """Copy length bytes at offset from one open file to another in constant memory.
+
+    Uses the kernel's copy_file_range where available, so data never
+    passes through Python; otherwise copies through a fixed-size buffer.
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(src.fileno(), dst.fileno(), length - copied, offset + copied)
+                if count == 0:
+                    break
+                copied += count
+            return
+        except OSError:
+            # Not supported for this filesystem pair, continue with plain copies
+            pass
+    
+    src.seek(offset + copied)
+    buffer = bytearray(SPLIT_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while copied < length:
+        count = src.readinto(view[:min(SPLIT_BUFFER_SIZE, length - copied)])
+        if not count:
+            break
+        dst.write(view[:count])
+        copied += count
+
+def iter_split_file(file_path: str) -> Iterator[Tuple[str, int]]:
+    """Split a large file for Telegram, yielding (part_path, total_parts) as each part is written.
+
+    Parts are produced lazily so the first one can be uploaded while the
+    rest are still being written.
+    """
     file_size = os.path.getsize(file_path)
     if file_size <= MAX_FILE_SIZE:
-        return [file_path]
+        yield file_path, 1
+        return
     
     base_name, ext = os.path.splitext(file_path)
     chunk_size = MAX_FILE_SIZE
-    chunks = []
     
-    # For videos, use ffmpeg to split
+    # For videos, cut on keyframes with ffmpeg's segment muxer
     if ext.lower() in ['.mp4', '.avi', '.mkv', '.mov']:
-        duration_cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', 
-                        '-of', 'default=noprint_wrappers=1:nokey=1', file_path]
-        duration = float(subprocess.check_output(duration_cmd).decode().strip())
-        
-        # Calculate segment duration based on file size
-        segment_duration = int((chunk_size / file_size) * duration)
-        if segment_duration < 1:
-            segment_duration = 1
-            
-        for i in range(0, int(duration), segment_duration):
-            chunk_path = f"{base_name}_part{i//segment_duration + 1}{ext}"
-            cmd = ['ffmpeg', '-ss', str(i), '-t', str(segment_duration), '-i', file_path, 
-                   '-c', 'copy', chunk_path]
-            subprocess.run(cmd, check=True)
-            chunks.append(chunk_path)
-    
-    # For audio, use direct binary splitting
-    elif ext.lower() in ['.mp3', '.m4a', '.wav']:
-        with open(file_path, 'rb') as f:
-            data = f.read()
-        
+        yield from iter_split_video(file_path)
+    
+    # Other audio containers have a header or index, so they are cut on time
+    elif ext.lower() in ['.m4a', '.wav']:
+        yield from iter_split_audio(file_path)
+    
+    # MP3 is a plain stream of frames, so direct binary splitting works
+    elif ext.lower() == '.mp3':
         total_chunks = (file_size + chunk_size - 1) // chunk_size
-        for i in range(total_chunks):
-            chunk_path = f"{base_name}_part{i+1}{ext}"
-            with open(chunk_path, 'wb') as f:
+        with open(file_path, 'rb') as src:
+            for i in range(total_chunks):
+                chunk_path = f"{base_name}_part{i+1}{ext}"
                 start = i * chunk_size
-                end = min((i + 1) * chunk_size, file_size)
-                f.write(data[start:end])
-            chunks.append(chunk_path)
+                with open(chunk_path, 'wb') as dst:
+                    copy_file_part(src, dst, start, min(chunk_size, file_size - start))
+                yield chunk_path, total_chunks
+
+def probe_keyframes(file_path: str) -> Tuple[float, List[Tuple[float, int]]]:
+    """Probe a video once, returning its duration and a (time, byte_offset) keyframe index.
+
+    Only the video packet headers are read (nothing is decoded), and the
+    output is parsed line by line so long videos don't need much memory.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'packet=pts_time,pos,flags:format=duration',
+           '-of', 'compact', file_path]
+    duration = 0.0
+    keyframes = []
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) as proc:
+        for line in proc.stdout:
+            section, _, rest = line.strip().partition('|')
+            fields = dict(field.split('=', 1) for field in rest.split('|') if '=' in field)
+            if section == 'packet' and fields.get('flags', '').startswith('K'):
+                try:
+                    keyframes.append((float(fields['pts_time']), int(fields['pos'])))
+                except (KeyError, ValueError):
+                    # Packets without a timestamp or position can't be cut points
+                    continue
+            elif section == 'format':
+                try:
+                    duration = float(fields.get('duration', 0))
+                except ValueError:
+                    pass
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
     
-    return chunks
+    keyframes.sort(key=lambda keyframe: keyframe[1])
+    return duration, keyframes
 
-# --- Command and Message Handlers ---
-async def check_channel_subscription(user_id: int) -> bool:
-    """Check if user is subscribed to the required channel."""
+def plan_segment_times(keyframes: List[Tuple[float, int]], file_size: int, target_size: int) -> List[float]:
+    """Choose keyframe cut times so that each segment stays under target_size bytes."""
+    cut_times = []
+    segment_start = 0
+    previous = None
+    for keyframe in keyframes + [(None, file_size)]:
+        # Cut at the last keyframe that still fits; a single oversized GOP
+        # gets its own segment and is caught by the size check afterwards
+        while (keyframe[1] - segment_start > target_size and previous
+               and previous[1] > segment_start and previous[0] > 0):
+            cut_times.append(previous[0])
+            segment_start = previous[1]
+        previous = keyframe
+    return cut_times
+
+def iter_split_video(file_path: str, depth: int = 0) -> Iterator[Tuple[str, int]]:
+    """Split a video on keyframes in a single ffmpeg pass, yielding (part_path, total_parts).
+
+    Cut points come from one probe of the keyframe index, so every part
+    starts on a keyframe and is sized to fit MAX_FILE_SIZE. Parts are
+    yielded as soon as ffmpeg finishes them; any part that still comes
+    out too big is split again.
+    """
+    file_size = os.path.getsize(file_path)
+    base_name, ext = os.path.splitext(file_path)
+    _, keyframes = probe_keyframes(file_path)
+    cut_times = plan_segment_times(keyframes, file_size, int(MAX_FILE_SIZE * SEGMENT_SIZE_MARGIN))
+    if not cut_times:
+        logger.warning(f"No keyframe cut points found for {file_path}, sending it whole")
+        yield file_path, 1
+        return
+    
+    yield from iter_segments(file_path, cut_times, lambda part: iter_split_video(part, depth + 1), depth)
+
+def iter_split_audio(file_path: str, depth: int = 0) -> Iterator[Tuple[str, int]]:
+    """Split an audio file on time in a single ffmpeg pass, yielding (part_path, total_parts).
+
+    Containers like M4A can't be cut at byte offsets (only the first piece
+    would have the index), so the audio is cut into equal durations sized
+    from its average bitrate, each part a complete file.
+    """
+    file_size = os.path.getsize(file_path)
+    duration = probe_video(file_path)['duration']
+    total_parts = -(-file_size // int(MAX_FILE_SIZE * SEGMENT_SIZE_MARGIN))
+    if not duration or total_parts < 2:
+        logger.warning(f"Can't plan audio cut points for {file_path}, sending it whole")
+        yield file_path, 1
+        return
+    cut_times = [duration * i / total_parts for i in range(1, total_parts)]
+    yield from iter_segments(file_path, cut_times, lambda part: iter_split_audio(part, depth + 1), depth)
+
+def iter_segments(file_path: str, cut_times: List[float],
+                  resplit: Callable[[str], Iterator[Tuple[str, int]]], depth: int) -> Iterator[Tuple[str, int]]:
+    """Cut a file at the given times with ffmpeg's segment muxer, yielding (part_path, total_parts).
+
+    Parts are yielded as soon as ffmpeg finishes them; any part that still
+    comes out too big is split again with resplit.
+    """
+    base_name, ext = os.path.splitext(file_path)
+    total_parts = len(cut_times) + 1
+    part_pattern = f"{base_name}_part%03d{ext}"
+    cmd = ['ffmpeg', '-v', 'error', '-y', '-i', file_path, '-c', 'copy',
+           '-f', 'segment', '-segment_times', ','.join(f"{t:.6f}" for t in cut_times),
+           '-reset_timestamps', '1',
+           '-segment_list', 'pipe:1', '-segment_list_type', 'flat']
+    if ext.lower() in ['.mp4', '.mov', '.m4a']:
+        cmd += ['-segment_format_options', 'movflags=+faststart']
+    cmd.append(part_pattern)
+    
+    # stderr goes to a file: a full stderr pipe would block ffmpeg while we wait on stdout
+    errors = tempfile.TemporaryFile(mode='w+')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errors, text=True)
     try:
-        bot = Bot(TOKEN)
-        member = await bot.get_chat_member(f"@{CHANNEL_USERNAME}", user_id)
-        subscription_status = member.status
-        # Consider administrators, creators, and members as subscribed
-        return subscription_status in ['member', 'administrator', 'creator']
-    except Exception as e:
-        logger.error(f"Error checking subscription: {e}")
-        # If there's an error checking, we'll consider them not subscribed to be safe
-        return False
+        # ffmpeg prints each part's name to the segment list once the part is complete
+        for line in proc.stdout:
+            part_path = os.path.join(os.path.dirname(file_path), line.strip())
+            if not line.strip() or not os.path.exists(part_path):
+                continue
+            
+            if os.path.getsize(part_path) > MAX_FILE_SIZE and depth < 2:
+                logger.info(f"Part {part_path} is over the size limit, splitting it again")
+                sub_parts = list(resplit(part_path))
+                if len(sub_parts) > 1:
+                    total_parts += len(sub_parts) - 1
+                    os.remove(part_path)
+                for sub_part, _ in sub_parts:
+                    yield sub_part, total_parts
+            else:
+                yield part_path, total_parts
+        
+        proc.wait()
+        errors.seek(0)
+        stderr = errors.read()
+        if proc.returncode:
+            logger.error(f"ffmpeg segmenting failed: {stderr}")
+            raise subprocess.CalledProcessError(proc.returncode, cmd, stderr=stderr)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        errors.close()
 
-async def get_subscription_keyboard():
-    """Get keyboard with subscription button."""
-    keyboard = [
-        [InlineKeyboardButton("✨ اشترك في القناة ✨", url=CHANNEL_LINK)],
-        [InlineKeyboardButton("✅ تم الاشتراك (التحقق)", callback_data="check_subscription")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+def split_large_file(file_path: str) -> List[str]:
+    """Split large files into smaller chunks for Telegram."""
+    return [chunk_path for chunk_path, _ in iter_split_file(file_path)]
 
-async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle /start command."""
-    # Track user in database and notify admin about new users
-    user = update.effective_user
-    is_new_user = add_user_to_db(
-        user.id, 
-        user.username, 
-        user.first_name, 
-        user.last_name
-    )
+# --- Download Executor ---
+_download_executor: Optional[Executor] = None
+
+def get_download_executor() -> Executor:
+    """Get the shared download worker pool, creating it on first use."""
+    global _download_executor
+    if _download_executor is None:
+        if DOWNLOAD_POOL_TYPE == 'process':
+            _download_executor = ProcessPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS)
+        else:
+            _download_executor = ThreadPoolExecutor(
+                max_workers=MAX_CONCURRENT_DOWNLOADS,
+                thread_name_prefix='download'
+            )
+        logger.info(f"Started {DOWNLOAD_POOL_TYPE} download pool with {MAX_CONCURRENT_DOWNLOADS} workers")
+    return _download_executor
+
+async def run_download_job(func, *args, **kwargs):
+    """Run a blocking download/processing function in the worker pool and await its result.
+
+    Jobs beyond MAX_CONCURRENT_DOWNLOADS wait in the pool's queue, so the
+    event loop stays free to serve other updates while downloads run.
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if DOWNLOAD_POOL_TYPE == 'thread':
+        # Carry context variables (e.g. current_platform) into the pool thread
+        call = functools.partial(contextvars.copy_context().run, call)
+    return await loop.run_in_executor(get_download_executor(), call)
+
+async def iterate_in_executor(func: Callable[..., Iterator], *args, max_pending: int = 1) -> AsyncIterator:
+    """Run a blocking generator in a worker thread and yield its items as they are produced.
+
+    The generator runs at most max_pending items ahead of the consumer, so
+    it is paused rather than buffered while the consumer is busy (e.g.
+    uploading). If the consumer stops early the generator is closed.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    slots = threading.Semaphore(max_pending)
+    stopped = threading.Event()
+    done = object()
     
-    # If it's a new user, notify admin
-    if is_new_user:
-        await notify_admin_about_new_user(context, user)
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            # Event loop already closed
+            stopped.set()
     
-    # Check if user is subscribed to the channel
-    is_subscribed = await check_channel_subscription(user.id)
+    def produce():
+        generator = func(*args)
+        try:
+            for item in generator:
+                # Wait until the consumer has taken earlier items
+                while not slots.acquire(timeout=0.5):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                put(item)
+            put(done)
+        except Exception as e:
+            put(done, e)
+        finally:
+            generator.close()
     
-    if not is_subscribed:
-        # Ask user to subscribe first
-        await update.message.reply_text(
-            f"👋 مرحبًا {user.first_name}! 🎉\n\n"
-            "⚠️ يجب عليك الاشتراك في قناتنا أولاً للاستمرار في استخدام البوت.\n\n"
-            "1️⃣ اضغط على زر \"اشترك في القناة\" أدناه\n"
-            "2️⃣ بعد الاشتراك، عد واضغط على \"تم الاشتراك (التحقق)\"\n\n"
-            "شكراً لدعمك! 🙏",
-            reply_markup=await get_subscription_keyboard()
-        )
-        return
+    # Producers run in the loop's default thread pool: they are mostly
+    # waiting on disk or ffmpeg and must be able to hand items back directly
+    loop.run_in_executor(None, contextvars.copy_context().run, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is done:
+                if error:
+                    raise error
+                return
+            slots.release()
+            yield item
+    finally:
+        stopped.set()
+
+def shutdown_download_executor():
+    """Stop the download worker pool."""
+    global _download_executor
+    if _download_executor is not None:
+        _download_executor.shutdown(wait=False, cancel_futures=True)
+        _download_executor = None
+        logger.info("Download pool stopped")
+
+# --- Bandwidth Budget ---
+class BandwidthBudget:
+    """Splits BANDWIDTH_LIMIT between the downloads running in this process.
+
+    Every job starts with an equal share. Once a second the shares are
+    rebalanced from measured rates: a job that didn't need its share (a
+    slow source) keeps a little headroom over its rate and the rest goes
+    to the jobs that were held back. Jobs are throttled from their
+    progress hooks, which run on the downloading threads, so plain,
+    chunked and parallel-fragment downloads are all covered.
+    """
     
-    # User is subscribed, show welcome message
-    await update.message.reply_text(
-        f"👋 مرحبًا {user.first_name}! 🎉\n\n"
-        "🎬 أرسل لي رابط من أي منصة لتحميله:\n"
+    REBALANCE_INTERVAL = 1.0
+    HEADROOM = 1.25
+    
+    def __init__(self, total: int):
+        self.total = total
+        self.lock = threading.Lock()
+        # job_id -> share, allowance, demand, and bytes used / throttled since the last rebalance
+        self.jobs: Dict[int, Dict[str, Any]] = {}
+        self.next_id = 0
+        self.rebalanced_at = time.monotonic()
+    
+    @property
+    def limit(self) -> int:
+        """The rate this process may use."""
+        if multiprocessing.parent_process():
+            # A download pool process runs one download at a time
+            return self.total // MAX_CONCURRENT_DOWNLOADS
+        return self.total
+    
+    def fair_share(self) -> Optional[int]:
+        """The rate a job starting now would get, or None without a limit."""
+        if self.limit <= 0:
+            return None
+        with self.lock:
+            return self.limit // (len(self.jobs) + 1)
+    
+    @contextlib.contextmanager
+    def job(self) -> Iterator[Optional[Callable]]:
+        """Register a download; yields the progress hook that throttles it."""
+        if self.limit <= 0:
+            yield None
+            return
+        with self.lock:
+            job_id = self.next_id
+            self.next_id += 1
+            now = time.monotonic()
+            self.jobs[job_id] = {'share': 0.0, 'allowance': 0.0, 'updated': now, 'since': now,
+                                 'demand': float('inf'), 'used': 0, 'throttled': False, 'seen': {}}
+            self._rebalance(measure=False)
+        try:
+            yield functools.partial(self.consume, job_id)
+        finally:
+            with self.lock:
+                del self.jobs[job_id]
+                self._rebalance(measure=False)
+    
+    def consume(self, job_id: int, d: Dict[str, Any]):
+        """Progress hook: account for new bytes and sleep off any overdraft."""
+        if d.get('status') != 'downloading':
+            return
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            # downloaded_bytes is cumulative per file (fragments are summed by yt-dlp)
+            filename = d.get('filename')
+            downloaded = d.get('downloaded_bytes') or 0
+            delta = downloaded - job['seen'].get(filename, 0)
+            job['seen'][filename] = downloaded
+            if delta <= 0:
+                return
+            
+            now = time.monotonic()
+            share = job['share']
+            job['allowance'] = min(job['allowance'] + (now - job['updated']) * share, share)
+            job['updated'] = now
+            job['allowance'] -= delta
+            job['used'] += delta
+            wait = -job['allowance'] / share if job['allowance'] < 0 else 0
+            if wait:
+                job['throttled'] = True
+            if now - self.rebalanced_at >= self.REBALANCE_INTERVAL:
+                self._rebalance(measure=True)
+        if wait:
+            time.sleep(wait)
+    
+    def _rebalance(self, measure: bool):
+        """Recompute the shares by water-filling the limit over the jobs' demands."""
+        now = time.monotonic()
+        if measure:
+            for job in self.jobs.values():
+                # Jobs that joined in this window are measured from when they joined
+                elapsed = now - max(self.rebalanced_at, job['since'])
+                if job['throttled'] or elapsed < self.REBALANCE_INTERVAL / 2:
+                    job['demand'] = float('inf')
+                else:
+                    job['demand'] = job['used'] / elapsed * self.HEADROOM
+                job['used'] = 0
+                job['throttled'] = False
+            self.rebalanced_at = now
+        
+        remaining = float(self.limit)
+        pending = sorted(self.jobs.values(), key=lambda job: job['demand'])
+        for i, job in enumerate(pending):
+            # Keep a floor so an idle job can show it wants more
+            job['share'] = max(min(job['demand'], remaining / (len(pending) - i)), self.limit / 100)
+            remaining = max(0.0, remaining - job['share'])
+
+bandwidth = BandwidthBudget(BANDWIDTH_LIMIT)
+
+# --- Progress Reporting ---
+# When each chat's status message was last edited, shared by all jobs in the chat
+_chat_last_edit: Dict[int, float] = {}
+
+def prune_chat_last_edit():
+    """Forget chats whose last edit no longer delays the next one."""
+    cutoff = time.monotonic() - PROGRESS_EDIT_INTERVAL
+    for chat_id in [chat_id for chat_id, edited in _chat_last_edit.items() if edited < cutoff]:
+        del _chat_last_edit[chat_id]
+
+def format_size(size: float) -> str:
+    """Format a byte count as megabytes."""
+    return f"{size / (1024 * 1024):.1f}MB"
+
+class ProgressReporter:
+    """Shows a job's progress in its status message without hitting edit rate limits.
+
+    Worker threads report yt-dlp progress through hook() and the event
+    loop reports stages and uploads through set(). Only the latest text
+    is kept, and it is written to the message at most once every
+    PROGRESS_EDIT_INTERVAL seconds per chat.
+    """
+    
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat_id
+        self.loop = asyncio.get_running_loop()
+        self.text: Optional[str] = None
+        self.shown_text: Optional[str] = None
+        self.changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+    
+    def set(self, text: str):
+        """Replace the progress text (event loop only)."""
+        if text != self.text:
+            self.text = text
+            self.changed.set()
+    
+    def hook(self, d: Dict[str, Any]):
+        """yt-dlp progress hook; called from download worker threads."""
+        if d.get('status') == 'downloading':
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if total:
+                text = f"⬇️ جارٍ التحميل... {downloaded * 100 // total}% ({format_size(downloaded)} / {format_size(total)})"
+            else:
+                text = f"⬇️ جارٍ التحميل... {format_size(downloaded)}"
+            if d.get('speed'):
+                text += f"\n🚀 {format_size(d['speed'])}/s"
+        elif d.get('status') == 'finished':
+            text = "⚙️ اكتمل التحميل، جارٍ المعالجة..."
+        else:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.set, text)
+        except RuntimeError:
+            # Event loop already closed
+            pass
+    
+    def upload(self, filename: str, sent_bytes: int, total_bytes: int):
+        """Report upload progress in bytes (event loop only)."""
+        percent = sent_bytes * 100 // total_bytes if total_bytes else 0
+        self.set(f"⬆️ جارٍ الرفع: {filename}\n{percent}% ({format_size(sent_bytes)} / {format_size(total_bytes)})")
+    
+    async def run(self):
+        """Write the latest text to the status message, throttled per chat."""
+        while True:
+            await self.changed.wait()
+            wait = _chat_last_edit.get(self.chat_id, 0) + PROGRESS_EDIT_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self.changed.clear()
+            if self.text == self.shown_text:
+                continue
+            
+            text = self.text
+            _chat_last_edit[self.chat_id] = time.monotonic()
+            try:
+                await self.message.edit_text(text)
+                self.shown_text = text
+            except RetryAfter as e:
+                # Telegram asked us to slow down; keep the text for the next try
+                _chat_last_edit[self.chat_id] = time.monotonic() + e.retry_after
+                self.changed.set()
+            except Exception as e:
+                logger.debug(f"Progress edit failed: {e}")
+    
+    async def close(self):
+        """Stop updating the status message."""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        prune_chat_last_edit()
+
+# --- Job Scheduler ---
+PRIORITY_SINGLE = 0  # Single videos/tracks go ahead of...
+PRIORITY_COLLECTION = 1  # ...playlists and albums
+
+class RateLimiter:
+    """Per-user token buckets limiting how often users can start new jobs.
+
+    The global and per-user caps on running jobs and their (priority,
+    age) order are enforced when workers claim jobs (see _claim_job).
+    """
+    
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        # user_id -> (tokens, last refill time)
+        self.buckets: Dict[int, Tuple[float, float]] = {}
+    
+    def check_rate(self, user_id: int) -> float:
+        """Take a token from the user's bucket; returns 0 if allowed, else seconds to wait."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(user_id, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens < 1:
+            self.buckets[user_id] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[user_id] = (tokens - 1, now)
+        if len(self.buckets) > RATE_LIMIT_MAX_USERS:
+            # Full buckets carry no state, so they can be forgotten
+            for bucket_user, (bucket_tokens, bucket_updated) in list(self.buckets.items()):
+                if bucket_tokens + (now - bucket_updated) * self.rate >= self.burst:
+                    del self.buckets[bucket_user]
+        return 0
+
+job_rate_limiter = RateLimiter(USER_JOBS_PER_MINUTE, USER_JOBS_BURST)
+
+# --- Storage Manager ---
+RECENT_DIR = os.path.join(DOWNLOAD_DIR, 'recent')
+
+def get_dir_size(path: str) -> int:
+    """Total size of the files under a directory (0 if it doesn't exist)."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass  # Removed while we were looking
+    return total
+
+def estimate_job_size(url: str, quality: str) -> int:
+    """Estimate the peak disk space a job will use, from probed metadata when available."""
+    size = None
+    if quality == 'fit':
+        size = MAX_FILE_SIZE
+    else:
+        info = get_cached_media_info(url)
+        estimate = estimate_quality(info, quality) if info else None
+        size = estimate[1] if estimate else None
+    size = size or STORAGE_DEFAULT_ESTIMATE
+    if is_collection_url(url):
+        # The playlist pipeline keeps at most this many entries on disk
+        size *= PLAYLIST_PREFETCH + 1
+    return int(size * STORAGE_OVERHEAD)
+
+class StorageManager:
+    """Disk space bookkeeping for DOWNLOAD_DIR.
+
+    Jobs reserve their estimated size before downloading and wait while
+    the disk (or STORAGE_QUOTA) can't take it; jobs that could never fit
+    are refused. Recently sent files can be kept in an LRU cache under
+    RECENT_DIR, which is evicted first when space runs low. A background
+    sweep removes files that no job owns.
+
+    The bookkeeping lives on the event loop; anything that touches the
+    disk (sizing directories, moving and removing files) runs in the
+    loop's default thread pool.
+    """
+    
+    def __init__(self):
+        # job_id -> reserved bytes
+        self.reservations: Dict[int, int] = {}
+        # cache_key -> (directory, size), least recently used first
+        self.recent: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()
+        self.recent_bytes = 0
+        self.released: Optional[asyncio.Event] = None
+        # Serializes measuring free space and taking a reservation
+        self.reserving: Optional[asyncio.Lock] = None
+    
+    @staticmethod
+    def available(reservations: Dict[int, int]) -> int:
+        """Bytes a new reservation may use, given a snapshot of the reservations (blocking)."""
+        # Reserved bytes that running jobs have not written yet
+        outstanding = sum(max(0, size - get_dir_size(get_job_dir(job_id)))
+                          for job_id, size in reservations.items())
+        available = shutil.disk_usage(DOWNLOAD_DIR).free - STORAGE_MIN_FREE - outstanding
+        if STORAGE_QUOTA:
+            available = min(available, STORAGE_QUOTA - get_dir_size(DOWNLOAD_DIR) - outstanding)
+        return available
+    
+    @staticmethod
+    def capacity() -> int:
+        """The most a single job could ever reserve."""
+        capacity = shutil.disk_usage(DOWNLOAD_DIR).total - STORAGE_MIN_FREE
+        return min(capacity, STORAGE_QUOTA) if STORAGE_QUOTA else capacity
+    
+    async def try_reserve(self, job_id: int, size: int) -> bool:
+        """Reserve space for a job if it is available now, evicting recent files if needed."""
+        loop = asyncio.get_running_loop()
+        async with self.reserving:
+            available = await loop.run_in_executor(None, self.available, dict(self.reservations))
+            while available < size and self.recent:
+                await self.evict_recent()
+                available = await loop.run_in_executor(None, self.available, dict(self.reservations))
+            if available < size:
+                return False
+            self.reservations[job_id] = size
+            return True
+    
+    async def reserve(self, job_id: int, size: int, on_wait: Optional[Callable] = None) -> bool:
+        """Wait until a job's space is reserved; returns False if it can never fit.
+
+        on_wait() is awaited once if the job has to wait.
+        """
+        if size > await asyncio.get_running_loop().run_in_executor(None, self.capacity):
+            logger.warning(f"Job {job_id} needs ~{format_size(size)}, more than the download disk allows")
+            return False
+        if self.released is None:
+            self.released = asyncio.Event()
+            self.reserving = asyncio.Lock()
+        waiting = False
+        while not await self.try_reserve(job_id, size):
+            if not waiting and on_wait:
+                await on_wait()
+            waiting = True
+            # Space is freed by our own jobs (released) or by other processes
+            self.released.clear()
+            try:
+                await asyncio.wait_for(self.released.wait(), STORAGE_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        return True
+    
+    def release(self, job_id: int):
+        """Drop a finished job's reservation."""
+        self.reservations.pop(job_id, None)
+        if self.released is not None:
+            self.released.set()
+    
+    @staticmethod
+    def _move_files(files: List[Tuple[str, bool]], recent_dir: str) -> int:
+        """Move files into a recent-files directory; returns their total size (blocking)."""
+        os.makedirs(recent_dir, exist_ok=True)
+        size = 0
+        for file_path, _ in files:
+            if os.path.exists(file_path):
+                size += os.path.getsize(file_path)
+                os.replace(file_path, os.path.join(recent_dir, os.path.basename(file_path)))
+        return size
+    
+    @staticmethod
+    def _link_files(recent_dir: str, job_dir: str, is_audio: bool) -> List[Tuple[str, bool]]:
+        """Link the files of a recent-files directory into a job directory (blocking)."""
+        for fname in os.listdir(recent_dir):
+            target = os.path.join(job_dir, fname)
+            try:
+                # A hard link survives eviction of the cached copy
+                os.link(os.path.join(recent_dir, fname), target)
+            except OSError:
+                shutil.copy2(os.path.join(recent_dir, fname), target)
+        return scan_job_dir(job_dir, is_audio)
+    
+    async def keep_recent(self, key: str, files: List[Tuple[str, bool]]):
+        """Move a finished job's files into the recent-files cache."""
+        if RECENT_FILES_MAX_BYTES <= 0:
+            return
+        await self.drop_recent(key)
+        recent_dir = os.path.join(RECENT_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+        loop = asyncio.get_running_loop()
+        try:
+            size = await loop.run_in_executor(None, self._move_files, files, recent_dir)
+        except Exception as e:
+            logger.error(f"Error keeping recent files: {e}")
+            await loop.run_in_executor(None, remove_job_dir, recent_dir)
+            return
+        self.recent[key] = (recent_dir, size)
+        self.recent_bytes += size
+        while self.recent_bytes > RECENT_FILES_MAX_BYTES and self.recent:
+            await self.evict_recent()
+    
+    async def get_recent(self, key: str, job_dir: str, is_audio: bool) -> Optional[List[Tuple[str, bool]]]:
+        """Link the recent files of a key into a job directory, or return None if there are none."""
+        if RECENT_FILES_MAX_BYTES <= 0:
+            return None
+        if key not in self.recent:
+            CACHE_LOOKUPS.inc(cache='recent', result='miss')
+            return None
+        CACHE_LOOKUPS.inc(cache='recent', result='hit')
+        recent_dir, _ = self.recent[key]
+        self.recent.move_to_end(key)
+        try:
+            files = await asyncio.get_running_loop().run_in_executor(
+                None, self._link_files, recent_dir, job_dir, is_audio)
+        except Exception as e:
+            logger.error(f"Error reusing recent files: {e}")
+            await self.drop_recent(key)
+            return None
+        return files or None
+    
+    async def drop_recent(self, key: str):
+        """Remove one entry of the recent-files cache."""
+        entry = self.recent.pop(key, None)
+        if entry:
+            self.recent_bytes -= entry[1]
+            await asyncio.get_running_loop().run_in_executor(None, remove_job_dir, entry[0])
+    
+    async def evict_recent(self):
+        """Remove the least recently used entry of the recent-files cache."""
+        key = next(iter(self.recent))
+        await self.drop_recent(key)
+    
+    @staticmethod
+    def sweep(job_ids: set, now: float):
+        """Remove files under DOWNLOAD_DIR that no job owns and that haven't changed for ORPHAN_MAX_AGE (blocking).
+
+        job_ids must include the jobs holding reservations, snapshotted on the event loop.
+        """
+        if not os.path.exists(DOWNLOAD_DIR):
+            return
+        for entry in os.scandir(DOWNLOAD_DIR):
+            if entry.path == RECENT_DIR:
+                continue
+            if entry.name.startswith('job_') and entry.name[4:].isdigit() and int(entry.name[4:]) in job_ids:
+                continue
+            try:
+                if now - entry.stat().st_mtime < ORPHAN_MAX_AGE:
+                    continue
+                logger.info(f"Sweeping orphaned download {entry.path}")
+                if entry.is_dir():
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error sweeping {entry.path}: {e}")
+
+storage = StorageManager()
+
+# --- Command and Message Handlers ---
+# Cached membership results: user_id -> (is_subscribed, expires_at)
+_subscription_cache: Dict[int, Tuple[bool, float]] = {}
+# Lookups in progress, shared by concurrent checks for the same user
+_subscription_lookups: Dict[int, asyncio.Future] = {}
+
+async def check_channel_subscription(bot: Bot, user_id: int) -> bool:
+    """Check if user is subscribed to the required channel.
+
+    Results are cached (non-members for a shorter time so they are
+    re-checked soon after joining), and concurrent checks for the same
+    user share a single getChatMember call.
+    """
+    now = time.monotonic()
+    cached = _subscription_cache.get(user_id)
+    if cached and cached[1] > now:
+        CACHE_LOOKUPS.inc(cache='subscription', result='hit')
+        return cached[0]
+    CACHE_LOOKUPS.inc(cache='subscription', result='miss')
+    
+    lookup = _subscription_lookups.get(user_id)
+    if lookup is None:
+        lookup = asyncio.ensure_future(fetch_channel_subscription(bot, user_id))
+        _subscription_lookups[user_id] = lookup
+        lookup.add_done_callback(lambda _: _subscription_lookups.pop(user_id, None))
+    return await asyncio.shield(lookup)
+
+async def fetch_channel_subscription(bot: Bot, user_id: int) -> bool:
+    """Ask Telegram whether user is a channel member and cache the answer."""
+    try:
+        with time_stage('subscription'):
+            member = await bot.get_chat_member(f"@{CHANNEL_USERNAME}", user_id)
+        subscription_status = member.status
+        # Consider administrators, creators, and members as subscribed
+        is_subscribed = subscription_status in ['member', 'administrator', 'creator']
+    except Exception as e:
+        logger.error(f"Error checking subscription: {e}")
+        ERRORS.inc(stage='subscription')
+        # If there's an error checking, we'll consider them not subscribed to be safe
+        # (errors are not cached so the next message checks again)
+        return False
+    
+    ttl = SUBSCRIPTION_CACHE_TTL if is_subscribed else SUBSCRIPTION_NEGATIVE_TTL
+    now = time.monotonic()
+    if len(_subscription_cache) >= SUBSCRIPTION_CACHE_MAX_USERS:
+        # Drop expired entries first, then the oldest if still full
+        for cached_user, (_, expires_at) in list(_subscription_cache.items()):
+            if expires_at <= now:
+                del _subscription_cache[cached_user]
+        while len(_subscription_cache) >= SUBSCRIPTION_CACHE_MAX_USERS:
+            del _subscription_cache[next(iter(_subscription_cache))]
+    _subscription_cache[user_id] = (is_subscribed, now + ttl)
+    return is_subscribed
+
+def invalidate_subscription_cache(user_id: int):
+    """Forget the cached subscription status of a user."""
+    _subscription_cache.pop(user_id, None)
+
+async def get_subscription_keyboard():
+    """Get keyboard with subscription button."""
+    keyboard = [
+        [InlineKeyboardButton("✨ اشترك في القناة ✨", url=CHANNEL_LINK)],
+        [InlineKeyboardButton("✅ تم الاشتراك (التحقق)", callback_data="check_subscription")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
+async def start_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /start command."""
+    # Track user in database and notify admin about new users
+    user = update.effective_user
+    is_new_user = await add_user_to_db(
+        user.id, 
+        user.username, 
+        user.first_name, 
+        user.last_name
+    )
+    
+    # If it's a new user, notify admin
+    if is_new_user:
+        await notify_admin_about_new_user(context, user)
+    
+    # Check if user is subscribed to the channel
+    is_subscribed = await check_channel_subscription(context.bot, user.id)
+    
+    if not is_subscribed:
+        # Ask user to subscribe first
+        await update.message.reply_text(
+            f"👋 مرحبًا {user.first_name}! 🎉\n\n"
+            "⚠️ يجب عليك الاشتراك في قناتنا أولاً للاستمرار في استخدام البوت.\n\n"
+            "1️⃣ اضغط على زر \"اشترك في القناة\" أدناه\n"
+            "2️⃣ بعد الاشتراك، عد واضغط على \"تم الاشتراك (التحقق)\"\n\n"
+            "شكراً لدعمك! 🙏",
+            reply_markup=await get_subscription_keyboard()
+        )
+        return
+    
+    # User is subscribed, show welcome message
+    await update.message.reply_text(
+        f"👋 مرحبًا {user.first_name}! 🎉\n\n"
+        "🎬 أرسل لي رابط من أي منصة لتحميله:\n"
         "▪️ YouTube\n▪️ Facebook\n▪️ Instagram\n▪️ TikTok\n"
         "▪️ Twitter (X)\n▪️ SoundCloud\n▪️ Spotify\n▪️ Snapchat\n\n"
         "🔍 يمكنك تحميل فيديوهات أو مقاطع صوتية بجودات مختلفة.\n"
@@ -454,7 +2210,7 @@ async def help_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "▪️ Spotify - أغاني وألبومات وقوائم تشغيل\n"
         "▪️ Snapchat - قصص عامة\n\n"
         "*ملاحظات:*\n"
-        "▪️ حجم الملف الأقصى: 50 ميغابايت\n"
+        f"▪️ حجم الملف الأقصى: {MAX_FILE_SIZE_MB} ميغابايت\n"
         "▪️ الملفات الكبيرة يتم تقسيمها تلقائيًا\n"
         "▪️ بعض المحتوى المحمي قد لا يمكن تحميله\n\n"
         "/start - للعودة للبداية\n"
@@ -470,9 +2226,11 @@ async def formats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "▪️ عالية: 1080p (Full HD)\n"
         "▪️ متوسطة: 720p (HD)\n"
         "▪️ منخفضة: 480p (SD)\n"
-        "▪️ صوت فقط: MP3\n\n"
+        f"▪️ مناسبة لتيليجرام: أفضل جودة في ملف واحد أقل من {MAX_FILE_SIZE_MB} ميغابايت\n"
+        "▪️ صوت فقط: M4A/MP3\n\n"
         "*للمقاطع الصوتية:*\n"
-        "▪️ MP3 بجودة 192kbps\n\n"
+        "▪️ الصوت الأصلي (M4A أو MP3) بدون إعادة ترميز\n"
+        f"▪️ الصيغ الأخرى تُحوَّل إلى MP3 بجودة {AUDIO_BITRATE}bps\n\n"
         "*ملاحظة:* قد لا تتوفر بعض الجودات حسب المنصة والمحتوى.",
         parse_mode="Markdown"
     )
@@ -481,7 +2239,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle incoming message with URL."""
     # Check if user is subscribed to the channel first
     user_id = update.effective_user.id
-    is_subscribed = await check_channel_subscription(user_id)
+    is_subscribed = await check_channel_subscription(context.bot, user_id)
     
     if not is_subscribed:
         await update.message.reply_text(
@@ -497,42 +2255,50 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     url = clean_url(text)
-    platform = detect_platform(url)
-    is_playlist = is_youtube_playlist(url)
+    platform, _, kind = parse_media_url(url)
     
     # If it's a YouTube playlist, inform the user
-    if is_playlist:
+    if platform == 'YouTube' and kind == 'playlist':
         await update.message.reply_text(
             "🔄 تم اكتشاف قائمة تشغيل YouTube. سأقوم بتحميل جميع الفيديوهات في القائمة.\n"
             "⚠️ قد يستغرق هذا بعض الوقت حسب عدد الفيديوهات."
         )
     
+    # Look at the media first so only real qualities (with sizes) are offered
+    reply = update.message.reply_text
+    info = None
+    if not is_collection_url(url) and platform != 'Spotify':
+        probe_msg = await update.message.reply_text("🔍 جارٍ تحليل الرابط...")
+        reply = probe_msg.edit_text
+        info = await get_media_info(url)
+    
     # Get quality options based on platform
-    options = get_quality_options(platform)
+    options, largest_size = get_probed_quality_options(platform, info)
+    if not options:
+        await reply(f"❌ الملف كبير جدًا للتحميل (الحد الأقصى {format_size(MAX_DOWNLOAD_SIZE)}).")
+        return
+    
+    prompt = f"🔍 اختر جودة التحميل من {platform}:"
+    if largest_size > MAX_FILE_SIZE:
+        prompt += f"\n⚠️ الملفات الأكبر من {MAX_FILE_SIZE_MB} ميغابايت سيتم تقسيمها إلى أجزاء."
     
     # If we have multiple quality options, show inline keyboard
     if len(options) > 1:
         buttons = []
+        # Store the URL under a short token that fits in callback data
+        url_token = await store_url_token(url)
         for quality, label in options.items():
-            # Create a unique but short callback data
-            # Format: dl|platform|quality|urlhash
-            url_hash = str(abs(hash(url)) % 10000000)
-            callback_data = f"dl|{platform[:3]}|{quality}|{url_hash}"
-            
-            # Store the URL in context
-            if not context.bot_data.get('urls'):
-                context.bot_data['urls'] = {}
-            context.bot_data['urls'][url_hash] = url
-            
+            # Format: dl|platform|quality|token
+            callback_data = f"dl|{platform[:3]}|{quality}|{url_token}"
             buttons.append([InlineKeyboardButton(label, callback_data=callback_data)])
             
         markup = InlineKeyboardMarkup(buttons)
-        await update.message.reply_text(f"🔍 اختر جودة التحميل من {platform}:", reply_markup=markup)
+        await reply(prompt, reply_markup=markup)
     else:
         # For platforms with only one quality option, proceed directly
         quality = list(options.keys())[0]
-        msg = await update.message.reply_text(f"⏳ جارٍ التحميل من {platform}...")
-        await process_download(update, msg, url, quality)
+        msg = await reply(f"⏳ جارٍ التحميل من {platform}...")
+        await process_download(user_id, msg, url, quality)
 
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle callback queries from inline keyboards."""
@@ -541,7 +2307,9 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # Handle verification of channel subscription
     if data[0] == "check_subscription":
-        is_subscribed = await check_channel_subscription(query.from_user.id)
+        # The user says they just joined, so don't trust a cached answer
+        invalidate_subscription_cache(query.from_user.id)
+        is_subscribed = await check_channel_subscription(context.bot, query.from_user.id)
         if is_subscribed:
             await query.edit_message_text(
                 "✅ تم التحقق من اشتراكك!\n\n"
@@ -555,10 +2323,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif data[0] == "dl":
         platform = data[1]
         quality = data[2]
-        url_hash = data[3]
+        url_token = data[3]
         
         # Verify user is subscribed
-        is_subscribed = await check_channel_subscription(query.from_user.id)
+        is_subscribed = await check_channel_subscription(context.bot, query.from_user.id)
         if not is_subscribed:
             await query.answer("يجب عليك الاشتراك في القناة أولاً!", show_alert=True)
             await query.edit_message_text(
@@ -567,8 +2335,8 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         
-        # Get the URL from context
-        url = context.bot_data.get('urls', {}).get(url_hash)
+        # Get the URL behind the button
+        url = await get_url_by_token(url_token)
         if not url:
             await query.answer("خطأ: لم يتم العثور على الرابط. يرجى إعادة إرسال الرابط.", show_alert=True)
             return
@@ -580,245 +2348,1362 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg = await query.edit_message_text(f"⏳ جارٍ التحميل... 0%")
         
         # Process the download
-        await process_download(update, msg, url, quality)
+        await process_download(query.from_user.id, msg, url, quality)
+
+async def process_download(user_id: int, message, url: str, quality: str = 'best'):
+    """Answer a download request from the file cache, or queue a job for the workers.
+
+    The job is run by whichever worker claims it first (see run_job), which
+    reports progress by editing message.
+    """
+    started = time.monotonic()
+    platform = detect_platform(url)
+    chat = message.chat
+    
+    # Repeat requests for the same media are re-sent from Telegram's servers
+    cache_key = get_cache_key(url, quality)
+    if cache_key:
+        cached_parts = await get_cached_files(cache_key)
+        if cached_parts and await resend_files(chat, message, cached_parts):
+            await record_download(user_id, platform, url, quality, 'cached', 0, time.monotonic() - started)
+            return
+    
+    # Only jobs that actually download count against the user's rate limit
+    wait = job_rate_limiter.check_rate(user_id)
+    if wait:
+        await message.edit_text(f"⏳ لقد أرسلت طلبات كثيرة. حاول مرة أخرى بعد {int(wait) + 1} ثانية.")
+        return
+    
+    priority = PRIORITY_COLLECTION if is_collection_url(url) else PRIORITY_SINGLE
+    job = await create_job(user_id, chat.id, message.message_id, url, quality, priority)
+    position = await get_queue_position(job)
+    if position:
+        await message.edit_text(f"⏳ تمت إضافة طلبك إلى قائمة الانتظار. ترتيبك: {position}")
+    wake_worker()
+
+async def run_job(bot: Bot, job: Dict[str, Any]):
+    """Run a job claimed by this worker: download, send, then finish it.
 
-async def process_download(update: Update, message, url: str, quality: str = 'best'):
-    """Process the download and send files to user."""
+    A job that was interrupted (by a restart or a dead worker) continues
+    in a new status message.
+    """
+    started = time.monotonic()
+    user_id, url, quality = job['user_id'], job['url'], job['quality']
+    platform = detect_platform(url)
+    current_platform.set(platform)
     try:
-        # Update progress message
-        await message.edit_text("⏳ جاري التحميل والمعالجة...")
+        if job['stage'] == 'queued' and job['message_id']:
+            message = get_status_message(bot, job['chat_id'], job['message_id'])
+        else:
+            message = await bot.send_message(job['chat_id'], "♻️ تمت إعادة تشغيل البوت، جارٍ استئناف التحميل...")
+    except Exception as e:
+        logger.error(f"Error starting job {job['id']}: {e}")
+        await finish_job(job)
+        return
+    chat = message.chat
+    cache_key = get_cache_key(url, quality)
+    result = job['result']
+    
+    # The same media may have been sent since this job was queued (identical
+    # jobs stay queued while one of them runs, see _claim_job)
+    if job['stage'] == 'queued' and cache_key:
+        cached_parts = await get_cached_files(cache_key)
+        if cached_parts and await resend_files(chat, message, cached_parts):
+            await finish_job(job)
+            await record_download(user_id, platform, url, quality, 'cached', 0, time.monotonic() - started)
+            return
+    
+    interrupted = False
+    try:
+        async def show_storage_wait():
+            await message.edit_text("⏳ مساحة التخزين ممتلئة حاليًا، سيبدأ التحميل عند توفر مساحة...")
         
-        # Download based on platform
-        if 'spotify.com' in url.lower():
+        if await storage.reserve(job['id'], estimate_job_size(url, quality), show_storage_wait):
             try:
-                files = download_spotify(url)
-            except Exception as e:
-                await message.edit_text(f"❌ فشل تحميل Spotify: {str(e)}")
-                return
+                await save_job(job, 'downloading')
+                await download_and_send(chat, message, url, quality, cache_key, job)
+            finally:
+                storage.release(job['id'])
+        else:
+            await message.edit_text("❌ هذا الملف أكبر من مساحة التخزين المتاحة على الخادم.")
+    except asyncio.CancelledError:
+        # Shutting down: keep the job and its files so it can be resumed
+        interrupted = True
+        raise
+    finally:
+        if not interrupted:
+            await finish_job(job)
+            status = 'success' if result['sent'] else 'failed'
+            await record_download(user_id, platform, url, quality, status, result['bytes'], time.monotonic() - started)
+
+def get_status_message(bot: Bot, chat_id: int, message_id: int) -> Message:
+    """Rebuild the status message of a job so a worker can edit it and send to its chat."""
+    chat = Chat(chat_id, Chat.PRIVATE)
+    chat.set_bot(bot)
+    message = Message(message_id, datetime.now(), chat)
+    message.set_bot(bot)
+    return message
+
+async def resend_files(chat, message, parts: List[Tuple[str, str, str]]) -> bool:
+    """Re-send already uploaded parts by file_id; returns False if that failed."""
+    try:
+        sent_count = await send_cached_files(chat, parts)
+        await message.edit_text(f"✅ تم إرسال {sent_count} ملف بنجاح!")
+        return True
+    except Exception as e:
+        # Stale file_ids fall through to a fresh download
+        logger.error(f"Error re-sending files: {e}")
+        return False
+
+async def download_and_send(chat, message, url: str, quality: str, cache_key: Optional[str], job: Dict[str, Any]):
+    """Download media into the job's directory and send it, adding upload totals to the job's result.
+
+    Files left in the directory by an interrupted run are picked up again:
+    yt-dlp continues its .part files and skips finished downloads, and
+    parts that were already sent are not sent twice.
+    """
+    # Every job works in its own directory so concurrent jobs never see each other's files
+    job_dir = get_job_dir(job['id'])
+    os.makedirs(job_dir, exist_ok=True)
+    result = job['result']
+    progress = ProgressReporter(message)
+    try:
+        # Update progress message
+        progress.set("⏳ جاري التحميل والمعالجة...")
+        
+        if is_collection_url(url):
+            # Playlists and albums are downloaded and sent item by item
+            await process_collection(chat, progress, url, quality, job_dir, job)
         else:
             try:
-                files = download_media(url, quality)
+                # Files sent recently may still be on disk
+                files = await storage.get_recent(cache_key, job_dir, quality == 'audio') if cache_key else None
+                if not files:
+                    files = await download_in_pool(url, quality, job_dir, progress, get_cached_media_info(url))
             except Exception as e:
-                await message.edit_text(f"❌ فشل التحميل: {str(e)}")
+                await progress.close()
+                if detect_platform(url) == 'Spotify':
+                    await message.edit_text(f"❌ فشل تحميل Spotify: {str(e)}")
+                else:
+                    await message.edit_text(f"❌ فشل التحميل: {str(e)}")
                 return
-        
-        if not files:
-            await message.edit_text("❌ لم يتم العثور على محتوى للتحميل.")
-            return
-        
-        # Update progress
-        await message.edit_text(f"✅ اكتمل التحميل! جارٍ الإرسال ({len(files)} ملف)...")
-        
-        # Send each file
-        sent_count = 0
-        for file_path, is_audio in files:
-            # Skip non-existent files
-            if not os.path.exists(file_path):
-                continue
-                
-            # Get file size
-            file_size = os.path.getsize(file_path)
-            filename = os.path.basename(file_path)
             
-            # Handle large files - split if needed
-            if file_size > MAX_FILE_SIZE:
-                await message.edit_text(f"📦 تقسيم الملف الكبير: {filename}")
-                chunks = split_large_file(file_path)
-                
-                for i, chunk in enumerate(chunks):
-                    chunk_name = os.path.basename(chunk)
-                    status = await send_file(update, chunk, is_audio, f"جزء {i+1}/{len(chunks)} - {filename}")
-                    if status:
-                        sent_count += 1
-                    # Clean up chunk
-                    if os.path.exists(chunk):
-                        os.remove(chunk)
-            else:
-                # Send regular sized file
-                status = await send_file(update, file_path, is_audio, filename)
-                if status:
-                    sent_count += 1
+            if not files:
+                await progress.close()
+                await message.edit_text("❌ لم يتم العثور على محتوى للتحميل.")
+                return
             
-            # Clean up original file
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # Update progress
+            progress.set(f"✅ اكتمل التحميل! جارٍ الإرسال ({len(files)} ملف)...")
+            await save_job(job, 'sending')
+            await send_downloaded_files(chat, progress, files, job)
+            if cache_key and result['parts'] and not result['failed']:
+                await storage.keep_recent(cache_key, files)
+        await progress.close()
+        
+        # Only complete results are cached
+        if cache_key and result['parts'] and not result['failed']:
+            await store_cached_files(cache_key, result['parts'])
         
         # Final status message
-        if sent_count > 0:
-            await message.edit_text(f"✅ تم إرسال {sent_count} ملف بنجاح!")
+        if result['sent'] > 0:
+            await message.edit_text(f"✅ تم إرسال {result['sent']} ملف بنجاح!")
         else:
             await message.edit_text("❌ لم يتم إرسال أي ملف.")
             
     except Exception as e:
         logger.error(f"Error in process_download: {str(e)}")
+        await progress.close()
         await message.edit_text(f"❌ حدث خطأ: {str(e)}")
+    finally:
+        await progress.close()
 
-async def send_file(update: Update, file_path: str, is_audio: bool, caption: str) -> bool:
-    """Send file to user as appropriate type."""
+async def download_in_pool(url: str, quality: str, job_dir: str, progress: ProgressReporter,
+                           info: Optional[Dict[str, Any]] = None) -> List[Tuple[str, bool]]:
+    """Run download_item in the worker pool, recording its time and the bytes downloaded."""
     try:
-        # Get the chat to send to
-        chat_id = update.effective_chat.id
+        with time_stage('download'):
+            files = await run_download_job(download_item, url, quality, job_dir, get_progress_hook(progress), info)
+    except Exception:
+        ERRORS.inc(stage='download')
+        raise
+    DOWNLOADED_BYTES.inc(sum(os.path.getsize(path) for path, _ in files if os.path.exists(path)),
+                         platform=current_platform.get())
+    return files
+
+def get_progress_hook(progress: ProgressReporter) -> Optional[Callable]:
+    """Get the yt-dlp progress hook for a job.
+
+    Hooks can't be sent to worker processes, so progress is only reported
+    with the thread pool.
+    """
+    return progress.hook if DOWNLOAD_POOL_TYPE == 'thread' else None
+
+def new_send_result() -> Dict[str, Any]:
+    """Create the running totals of a job's uploads.
+
+    'sent'/'failed' count uploaded parts, 'bytes' is the size of the sent
+    parts and 'parts' holds their (file_type, file_id, caption) for the
+    file cache. 'done' lists the keys of parts and playlist entries that
+    were already handled, so a resumed job skips them.
+    """
+    return {'sent': 0, 'failed': 0, 'bytes': 0, 'parts': [], 'done': []}
+
+async def process_collection(chat, progress: ProgressReporter, url: str, quality: str, job_dir: str, job: Dict[str, Any]):
+    """Download and send a playlist or album as a pipeline.
+
+    Entries are listed lazily and each one is downloaded by a pool worker
+    and sent as soon as it is ready, in playlist order. At most
+    PLAYLIST_PREFETCH entries are downloaded ahead of the one being sent,
+    which bounds the number of finished-but-unsent files on disk.
+    Upload totals are added to the job's result; entries finished before
+    a restart are skipped.
+    """
+    result = job['result']
+    queue: asyncio.Queue = asyncio.Queue()
+    # One slot per entry that is downloading, downloaded or being sent
+    slots = asyncio.Semaphore(PLAYLIST_PREFETCH + 1)
+    
+    async def produce():
+        try:
+            index = 0
+            async for entry_url in iterate_in_executor(iter_collection_entries, url, job_dir,
+                                                       max_pending=PLAYLIST_PREFETCH):
+                index += 1
+                if f"item_{index:04d}" in result['done']:
+                    continue
+                await slots.acquire()
+                entry_dir = os.path.join(job_dir, f"item_{index:04d}")
+                task = asyncio.ensure_future(download_in_pool(entry_url, quality, entry_dir, progress))
+                await queue.put((index, entry_dir, task))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error listing entries of {url}: {e}")
+        await queue.put(None)
+    
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            index, entry_dir, task = item
+            
+            progress.set(f"⏳ جارٍ تحميل العنصر {index}... (تم إرسال {result['sent']} ملف)")
+            try:
+                files = await task
+            except Exception as e:
+                logger.error(f"Error downloading entry {index} of {url}: {e}")
+                result['failed'] += 1
+                result['done'].append(f"item_{index:04d}")
+                await save_job(job)
+                remove_job_dir(entry_dir)
+                slots.release()
+                continue
+            
+            await send_downloaded_files(chat, progress, files, job)
+            result['done'].append(f"item_{index:04d}")
+            await save_job(job)
+            remove_job_dir(entry_dir)
+            slots.release()
+    finally:
+        # Stop listing and drop downloads that will never be sent
+        producer.cancel()
+        while not queue.empty():
+            item = queue.get_nowait()
+            if item:
+                item[2].cancel()
+
+async def send_downloaded_files(chat, progress: ProgressReporter, files: List[Tuple[str, bool]], job: Dict[str, Any]):
+    """Send downloaded files, splitting large ones, and delete them afterwards.
+
+    Upload totals are added to the job's result (see new_send_result) and
+    saved after every part, so parts sent before a restart are skipped.
+    """
+    result = job['result']
+    total_bytes = sum(os.path.getsize(path) for path, _ in files if os.path.exists(path))
+    sent_bytes = 0
+    for file_path, is_audio in files:
+        # Skip non-existent files
+        if not os.path.exists(file_path):
+            continue
+            
+        # Get file size
+        file_size = os.path.getsize(file_path)
+        filename = os.path.basename(file_path)
+        part_key = os.path.relpath(file_path, DOWNLOAD_DIR)
         
-        if is_audio:
-            # Send as audio file
-            with open(file_path, 'rb') as f:
-                await update.effective_chat.send_audio(
-                    audio=f,
-                    caption=caption[:1024],  # Telegram caption limit
-                    title=os.path.splitext(caption)[0][:64],  # Telegram title limit
-                    performer="Downloaded by Downloader Bot"
-                )
-        else:
-            # Determine file type by extension
-            ext = os.path.splitext(file_path)[1].lower()
+        # Handle large files - split if needed
+        if file_size > MAX_FILE_SIZE:
+            progress.set(f"📦 تقسيم الملف الكبير: {filename}")
             
-            if ext in ['.mp4', '.avi', '.mov', '.mkv']:
-                # Send as video
-                with open(file_path, 'rb') as f:
-                    try:
-                        await update.effective_chat.send_video(
-                            video=f,
-                            caption=caption[:1024]
-                        )
-                    except Exception:
-                        # If failed, try as document
-                        with open(file_path, 'rb') as f2:
-                            await update.effective_chat.send_document(
-                                document=f2,
-                                caption=caption[:1024]
-                            )
-            else:
-                # Send as generic document
-                with open(file_path, 'rb') as f:
-                    await update.effective_chat.send_document(
-                        document=f,
-                        caption=caption[:1024]
-                    )
-        return True
+            # Each part is uploaded as soon as it has been written; only the
+            # time spent waiting for parts counts as splitting
+            i = 0
+            split_time = 0.0
+            waiting_since = time.monotonic()
+            async for chunk, total_chunks in iterate_in_executor(iter_split_file, file_path):
+                split_time += time.monotonic() - waiting_since
+                i += 1
+                caption = f"جزء {i}/{total_chunks} - {filename}"
+                chunk_size = os.path.getsize(chunk)
+                if f"{part_key}#{i}" not in result['done']:
+                    progress.upload(os.path.basename(chunk), sent_bytes, total_bytes)
+                    sent = await send_file(chat, chunk, is_audio, caption)
+                    add_send_result(result, sent, caption, chunk_size)
+                    result['done'].append(f"{part_key}#{i}")
+                    await save_job(job)
+                sent_bytes += chunk_size
+                # Clean up chunk
+                if os.path.exists(chunk):
+                    os.remove(chunk)
+                waiting_since = time.monotonic()
+            split_time += time.monotonic() - waiting_since
+            STAGE_SECONDS.observe(split_time, stage='split', platform=current_platform.get())
+        elif part_key not in result['done']:
+            # Send regular sized file
+            progress.upload(filename, sent_bytes, total_bytes)
+            sent = await send_file(chat, file_path, is_audio, filename)
+            add_send_result(result, sent, filename, file_size)
+            result['done'].append(part_key)
+            await save_job(job)
+            sent_bytes += file_size
+        # The original stays in the job directory until the job (or playlist
+        # entry) is finished, so a resumed job doesn't download it again
+
+def add_send_result(result: Dict[str, Any], sent: Optional[Tuple[str, str]], caption: str, size: int):
+    """Add the outcome of one send_file call to a job's upload totals."""
+    if sent:
+        result['sent'] += 1
+        result['bytes'] += size
+        result['parts'].append((sent[0], sent[1], caption))
+    else:
+        result['failed'] += 1
+
+def get_sent_file(sent_message) -> Optional[Tuple[str, str]]:
+    """Get (file_type, file_id) of the media attached to a sent message."""
+    for file_type in ('video', 'audio', 'document', 'animation'):
+        media = getattr(sent_message, file_type, None)
+        if media:
+            return file_type, media.file_id
+    return None
+
+def open_upload(file_path: str):
+    """Open a file for upload.
+
+    With a local Bot API server the server reads the file itself, so only
+    its path is passed (python-telegram-bot sends it as a file:// URI).
+    """
+    if BOT_API_LOCAL_MODE:
+        return contextlib.nullcontext(Path(file_path).absolute())
+    return open(file_path, 'rb')
+
+async def send_file(chat, file_path: str, is_audio: bool, caption: str) -> Optional[Tuple[str, str]]:
+    """Send file to user as appropriate type.
+
+    Videos are checked first (see prepare_video), so each file is
+    uploaded once, as the type Telegram can actually use.
+    Returns (file_type, file_id) of the uploaded file, or None on failure.
+    """
+    upload_path = file_path
+    try:
+        video = None
+        if not is_audio and os.path.splitext(file_path)[1].lower() in VIDEO_EXTENSIONS:
+            loop = asyncio.get_running_loop()
+            upload_path, video = await loop.run_in_executor(
+                None, contextvars.copy_context().run, prepare_video, file_path)
+        with time_stage('upload'):
+            sent = await upload_file(chat, upload_path, is_audio, caption, video)
+        UPLOADED_BYTES.inc(os.path.getsize(upload_path), platform=current_platform.get())
+        return get_sent_file(sent)
     except Exception as e:
         logger.error(f"Error sending file: {e}")
+        ERRORS.inc(stage='upload')
         try:
-            await update.effective_chat.send_message(f"❌ فشل إرسال الملف: {caption}")
+            await chat.send_message(f"❌ فشل إرسال الملف: {caption}")
         except:
             pass
-        return False
+        return None
+    finally:
+        if upload_path != file_path and os.path.exists(upload_path):
+            os.remove(upload_path)
+
+async def upload_file(chat, file_path: str, is_audio: bool, caption: str,
+                      video: Optional[Dict[str, Any]] = None):
+    """Upload a file to the chat as audio, video or document; returns the sent message.
+
+    Files are sent as video only when send_video arguments from
+    prepare_video are given.
+    """
+    if is_audio:
+        # Send as audio file
+        with open_upload(file_path) as f:
+            sent = await chat.send_audio(
+                audio=f,
+                caption=caption[:1024],  # Telegram caption limit
+                title=os.path.splitext(caption)[0][:64],  # Telegram title limit
+                performer="Downloaded by Downloader Bot"
+            )
+    elif video is not None:
+        # Send as video
+        with open_upload(file_path) as f:
+            sent = await chat.send_video(
+                video=f,
+                caption=caption[:1024],
+                **video
+            )
+    else:
+        # Send as generic document
+        with open_upload(file_path) as f:
+            sent = await chat.send_document(
+                document=f,
+                caption=caption[:1024]
+            )
+    return sent
+
+async def send_by_file_id(chat, file_type: str, file_id: str, caption: str):
+    """Re-send an already uploaded file using its Telegram file_id."""
+    if file_type == 'audio':
+        await chat.send_audio(
+            audio=file_id,
+            caption=caption[:1024],
+            title=os.path.splitext(caption)[0][:64],
+            performer="Downloaded by Downloader Bot"
+        )
+    elif file_type == 'video':
+        await chat.send_video(video=file_id, caption=caption[:1024])
+    elif file_type == 'animation':
+        await chat.send_animation(animation=file_id, caption=caption[:1024])
+    else:
+        await chat.send_document(document=file_id, caption=caption[:1024])
+
+async def send_cached_files(chat, parts: List[Tuple[str, str, str]]) -> int:
+    """Send cached (file_type, file_id, caption) parts; returns the number of files sent.
+
+    Consecutive parts of the same type go out as one media group (up to 10
+    files per call), so most cache hits cost a single API request.
+    """
+    sent_count = 0
+    i = 0
+    while i < len(parts):
+        file_type = parts[i][0]
+        group = [parts[i]]
+        if file_type in INPUT_MEDIA_TYPES:
+            while (i + len(group) < len(parts) and len(group) < 10
+                   and parts[i + len(group)][0] == file_type):
+                group.append(parts[i + len(group)])
+        
+        if len(group) == 1:
+            _, file_id, caption = group[0]
+            await send_by_file_id(chat, file_type, file_id, caption)
+        else:
+            media_class = INPUT_MEDIA_TYPES[file_type]
+            await chat.send_media_group(
+                media=[media_class(media=file_id, caption=caption[:1024]) for _, file_id, caption in group]
+            )
+        sent_count += len(group)
+        i += len(group)
+    return sent_count
 
 # --- Database Functions ---
+# All database work runs on one dedicated thread that owns a single
+# long-lived connection; handlers await the results through run_db().
+_db_executor: Optional[ThreadPoolExecutor] = None
+# Set once close_database has run, so late callers (e.g. metrics scrapes) don't reopen it
+_db_closed = False
+_db_connection: Optional[sqlite3.Connection] = None
+# Download records waiting for the next batched insert
+_pending_downloads: List[Tuple[Any, ...]] = []
+_download_flush_task: Optional[asyncio.Task] = None
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Get the single-threaded executor that owns the database connection."""
+    global _db_executor
+    if _db_executor is None:
+        _db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='database')
+    return _db_executor
+
+def get_db_connection() -> sqlite3.Connection:
+    """Get the long-lived database connection (only used from the database thread)."""
+    global _db_connection
+    if _db_connection is None:
+        conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+        # WAL lets readers run alongside the writer, and NORMAL sync only
+        # fsyncs at checkpoints, which is safe in WAL mode
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA busy_timeout=30000")
+        _db_connection = conn
+    return _db_connection
+
+def run_db_sync(func, *args):
+    """Run func(conn, *args) on the database thread and wait for its result."""
+    return get_db_executor().submit(lambda: func(get_db_connection(), *args)).result()
+
+async def run_db(func, *args):
+    """Run func(conn, *args) on the database thread and await its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_db_executor(), lambda: func(get_db_connection(), *args))
+
+def _init_database(conn: sqlite3.Connection):
+    """Create tables if they don't exist yet."""
+    cursor = conn.cursor()
+    
+    # Create users table if not exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    # Create downloads table if not exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS downloads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        platform TEXT,
+        url TEXT,
+        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    
+    # Create cache of uploaded Telegram files if not exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_cache (
+        cache_key TEXT NOT NULL,
+        part INTEGER NOT NULL,
+        file_type TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        caption TEXT,
+        created_at REAL NOT NULL,
+        last_used REAL NOT NULL,
+        PRIMARY KEY (cache_key, part)
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_cache_last_used ON file_cache (last_used)")
+    
+    # Create store of URLs behind inline keyboard buttons if not exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS url_tokens (
+        token TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        created_at REAL NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_url_tokens_created_at ON url_tokens (created_at)")
+    
+    # Create table of unfinished download jobs if not exists
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        chat_id INTEGER NOT NULL,
+        url TEXT NOT NULL,
+        quality TEXT NOT NULL,
+        stage TEXT NOT NULL DEFAULT 'queued',
+        result TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    ''')
+    
+    conn.commit()
+    migrate_database(conn)
+
+def migrate_database(conn: sqlite3.Connection):
+    """Bring an existing database up to the current schema (tracked in PRAGMA user_version)."""
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    
+    if version < 1:
+        with conn:
+            # Per-download details
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(downloads)")}
+            for column, column_type in [('status', 'TEXT'), ('quality', 'TEXT'),
+                                        ('bytes', 'INTEGER'), ('duration', 'REAL')]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE downloads ADD COLUMN {column} {column_type}")
+            
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_user ON downloads (user_id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_timestamp ON downloads (timestamp)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_downloads_platform ON downloads (platform)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date)")
+            
+            # Rollups kept up to date by triggers, so /stats reads a handful
+            # of rows instead of scanning the downloads table
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS platform_stats (
+                platform TEXT PRIMARY KEY,
+                downloads INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0
+            )
+            ''')
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS daily_stats (
+                day TEXT NOT NULL,
+                platform TEXT NOT NULL,
+                downloads INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, platform)
+            )
+            ''')
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_users_count AFTER INSERT ON users
+            BEGIN
+                INSERT INTO counters (name, value) VALUES ('users', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            END
+            ''')
+            conn.execute('''
+            CREATE TRIGGER IF NOT EXISTS trg_downloads_rollup AFTER INSERT ON downloads
+            BEGIN
+                INSERT INTO platform_stats (platform, downloads, failures, bytes)
+                VALUES (NEW.platform, COALESCE(NEW.status, 'success') != 'failed',
+                        COALESCE(NEW.status, 'success') = 'failed', COALESCE(NEW.bytes, 0))
+                ON CONFLICT(platform) DO UPDATE SET
+                    downloads = downloads + excluded.downloads,
+                    failures = failures + excluded.failures,
+                    bytes = bytes + excluded.bytes;
+                INSERT INTO daily_stats (day, platform, downloads, failures, bytes)
+                VALUES (date(NEW.timestamp), NEW.platform, COALESCE(NEW.status, 'success') != 'failed',
+                        COALESCE(NEW.status, 'success') = 'failed', COALESCE(NEW.bytes, 0))
+                ON CONFLICT(day, platform) DO UPDATE SET
+                    downloads = downloads + excluded.downloads,
+                    failures = failures + excluded.failures,
+                    bytes = bytes + excluded.bytes;
+            END
+            ''')
+            
+            # Backfill the rollups from rows recorded before they existed
+            conn.execute("INSERT OR REPLACE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+            conn.execute(
+                "INSERT OR REPLACE INTO platform_stats (platform, downloads, failures, bytes) "
+                "SELECT platform, COUNT(*), 0, 0 FROM downloads GROUP BY platform"
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO daily_stats (day, platform, downloads, failures, bytes) "
+                "SELECT date(timestamp), platform, COUNT(*), 0, 0 FROM downloads GROUP BY date(timestamp), platform"
+            )
+            conn.execute("PRAGMA user_version = 1")
+    
+    if version < 2:
+        with conn:
+            # Jobs become a queue shared by the frontend and the workers
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for column, column_type in [('message_id', 'INTEGER'), ('priority', 'INTEGER NOT NULL DEFAULT 0'),
+                                        ('worker', 'TEXT'), ('heartbeat_at', 'REAL')]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queue ON jobs (worker, priority, id)")
+            
+            # Leases for leader election between bot instances
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                holder TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+            ''')
+            conn.execute("PRAGMA user_version = 2")
+    
+    if version < 3:
+        with conn:
+            # Identical jobs are held back while one of them runs
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if 'flight_key' not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN flight_key TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_flight ON jobs (flight_key, worker)")
+            conn.execute("PRAGMA user_version = 3")
+
 def init_database():
     """Initialize SQLite database for user tracking."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Create users table if not exists
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            join_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Create downloads table if not exists
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS downloads (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            platform TEXT,
-            url TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users (id)
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        run_db_sync(_init_database)
     except Exception as e:
         logger.error(f"Database initialization error: {e}")
 
-def add_user_to_db(user_id, username, first_name, last_name):
+def _close_database(conn: sqlite3.Connection):
+    """Close the connection (runs on the database thread)."""
+    global _db_connection
+    conn.close()
+    _db_connection = None
+
+async def close_database():
+    """Write out pending records and close the database connection."""
+    global _db_executor, _db_closed
+    await flush_downloads()
+    try:
+        await run_db(_close_database)
+    except Exception as e:
+        logger.error(f"Error closing database: {e}")
+    _db_closed = True
+    if _db_executor is not None:
+        _db_executor.shutdown(wait=True)
+        _db_executor = None
+
+def _add_user(conn: sqlite3.Connection, user_id, username, first_name, last_name) -> bool:
+    """Insert a user unless they exist; returns True if the user was new."""
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(id) DO NOTHING",
+            (user_id, username, first_name, last_name)
+        )
+    return cursor.rowcount == 1
+
+async def add_user_to_db(user_id, username, first_name, last_name) -> bool:
     """Add new user to database. Returns True if new user, False if existing."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Check if user exists
-        cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
-        existing = cursor.fetchone()
-        
-        if not existing:
-            # Add new user
-            cursor.execute(
-                "INSERT INTO users (id, username, first_name, last_name) VALUES (?, ?, ?, ?)",
-                (user_id, username, first_name, last_name)
-            )
-            conn.commit()
-            conn.close()
-            return True  # New user
-        
-        conn.close()
-        return False  # Existing user
+        return await run_db(_add_user, user_id, username, first_name, last_name)
     except Exception as e:
         logger.error(f"Error adding user to database: {e}")
         return False
 
-def record_download(user_id, platform, url):
-    """Record download in database."""
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        cursor.execute(
-            "INSERT INTO downloads (user_id, platform, url) VALUES (?, ?, ?)",
-            (user_id, platform, url)
+def _insert_downloads(conn: sqlite3.Connection, rows: List[Tuple[Any, ...]]):
+    """Insert a batch of download records."""
+    with conn:
+        conn.executemany(
+            "INSERT INTO downloads (user_id, platform, url, quality, status, bytes, duration) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows
         )
-        
-        conn.commit()
-        conn.close()
+
+async def record_download(user_id, platform, url, quality=None, status='success', size=0, duration=None):
+    """Record download in database.
+
+    status is 'success', 'cached' (re-sent from the file cache) or
+    'failed'; size is the number of bytes sent and duration the job's
+    wall time in seconds. Records are queued and written in batches by
+    flush_downloads().
+    """
+    _pending_downloads.append((user_id, platform, url, quality, status, size, duration))
+    REQUESTS_TOTAL.inc(platform=platform, status=status)
+    if duration is not None:
+        STAGE_SECONDS.observe(duration, stage='request', platform=platform)
+    if len(_pending_downloads) >= DOWNLOAD_BATCH_SIZE:
+        await flush_downloads()
+
+async def flush_downloads():
+    """Write all queued download records in one transaction."""
+    global _pending_downloads
+    if not _pending_downloads:
+        return
+    rows, _pending_downloads = _pending_downloads, []
+    try:
+        await run_db(_insert_downloads, rows)
     except Exception as e:
-        logger.error(f"Error recording download: {e}")
+        logger.error(f"Error recording downloads: {e}")
+
+async def download_flush_loop():
+    """Periodically write queued download records."""
+    while True:
+        await asyncio.sleep(DOWNLOAD_FLUSH_INTERVAL)
+        await flush_downloads()
 
-def get_user_stats():
+def _get_user_stats(conn: sqlite3.Connection) -> Dict[str, Any]:
+    """Query user and download statistics."""
+    cursor = conn.cursor()
+    
+    # Total users
+    cursor.execute("SELECT value FROM counters WHERE name = 'users'")
+    row = cursor.fetchone()
+    total_users = row[0] if row else 0
+    
+    # Downloads per platform
+    cursor.execute("SELECT platform, downloads FROM platform_stats WHERE downloads > 0 ORDER BY downloads DESC")
+    platform_stats = cursor.fetchall()
+    
+    # Total downloads
+    total_downloads = sum(count for _, count in platform_stats)
+    
+    # Today's downloads
+    cursor.execute("SELECT COALESCE(SUM(downloads), 0) FROM daily_stats WHERE day = date('now')")
+    today_downloads = cursor.fetchone()[0]
+    
+    # Recent users
+    cursor.execute("SELECT id, username, first_name, join_date FROM users ORDER BY join_date DESC LIMIT 5")
+    recent_users = cursor.fetchall()
+    
+    return {
+        "total_users": total_users,
+        "total_downloads": total_downloads,
+        "today_downloads": today_downloads,
+        "platform_stats": platform_stats,
+        "recent_users": recent_users
+    }
+
+async def get_user_stats():
     """Get user statistics from database."""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Total users
-        cursor.execute("SELECT COUNT(*) FROM users")
-        total_users = cursor.fetchone()[0]
-        
-        # Total downloads
-        cursor.execute("SELECT COUNT(*) FROM downloads")
-        total_downloads = cursor.fetchone()[0]
-        
-        # Downloads per platform
-        cursor.execute("SELECT platform, COUNT(*) FROM downloads GROUP BY platform")
-        platform_stats = cursor.fetchall()
-        
-        # Recent users
-        cursor.execute("SELECT id, username, first_name, join_date FROM users ORDER BY join_date DESC LIMIT 5")
-        recent_users = cursor.fetchall()
-        
-        conn.close()
-        
-        return {
-            "total_users": total_users,
-            "total_downloads": total_downloads,
-            "platform_stats": platform_stats,
-            "recent_users": recent_users
-        }
+        await flush_downloads()
+        return await run_db(_get_user_stats)
     except Exception as e:
         logger.error(f"Error getting user stats: {e}")
         return {
             "total_users": 0,
             "total_downloads": 0,
+            "today_downloads": 0,
             "platform_stats": [],
             "recent_users": []
         }
 
+async def on_startup(application: Application):
+    """Start background work once the application is running."""
+    global _download_flush_task, _lease_task
+    _download_flush_task = asyncio.ensure_future(download_flush_loop())
+    _lease_task = asyncio.ensure_future(lease_loop(application))
+    if EMBEDDED_WORKER:
+        await start_worker(application.bot)
+
+async def on_shutdown(application: Application):
+    """Stop background work, give up the frontend role and close the database."""
+    await stop_worker()
+    if _lease_task is not None:
+        _lease_task.cancel()
+        try:
+            await run_db(_release_lease, FRONTEND_LEASE, WORKER_ID)
+        except Exception as e:
+            logger.error(f"Error releasing frontend lease: {e}")
+    if _download_flush_task is not None:
+        _download_flush_task.cancel()
+    await close_database()
+
+# --- File ID Cache ---
+def get_cache_key(url: str, quality: str) -> Optional[str]:
+    """Get the file cache key for a URL and quality, or None if the URL can't be cached."""
+    media_key = get_media_key(url)
+    if not media_key:
+        return None
+    return f"{media_key}|{quality}"
+
+def get_flight_key(url: str, quality: str) -> str:
+    """Get the key under which identical download jobs are run only once."""
+    return get_cache_key(url, quality) or f"{url}|{quality}"
+
+def _get_cached_files(conn: sqlite3.Connection, cache_key: str) -> List[Tuple[str, str, str]]:
+    """Look up unexpired cached parts and mark them as recently used."""
+    now = time.time()
+    with conn:
+        parts = conn.execute(
+            "SELECT file_type, file_id, caption FROM file_cache "
+            "WHERE cache_key = ? AND created_at > ? ORDER BY part",
+            (cache_key, now - FILE_CACHE_TTL)
+        ).fetchall()
+        if parts:
+            conn.execute("UPDATE file_cache SET last_used = ? WHERE cache_key = ?", (now, cache_key))
+    return parts
+
+async def get_cached_files(cache_key: str) -> List[Tuple[str, str, str]]:
+    """Get cached (file_type, file_id, caption) parts for a key, or [] on a miss."""
+    try:
+        parts = await run_db(_get_cached_files, cache_key)
+    except Exception as e:
+        logger.error(f"Error reading file cache: {e}")
+        return []
+    
+    CACHE_LOOKUPS.inc(cache='file', result='hit' if parts else 'miss')
+    return parts
+
+def _store_cached_files(conn: sqlite3.Connection, cache_key: str, parts: List[Tuple[str, str, str]]):
+    """Replace the cached parts of a key and evict old entries."""
+    now = time.time()
+    with conn:
+        conn.execute("DELETE FROM file_cache WHERE cache_key = ?", (cache_key,))
+        conn.executemany(
+            "INSERT INTO file_cache (cache_key, part, file_type, file_id, caption, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(cache_key, i, file_type, file_id, caption, now, now)
+             for i, (file_type, file_id, caption) in enumerate(parts)]
+        )
+        evict_file_cache(conn, now)
+
+async def store_cached_files(cache_key: str, parts: List[Tuple[str, str, str]]):
+    """Store the uploaded (file_type, file_id, caption) parts for a key."""
+    try:
+        await run_db(_store_cached_files, cache_key, parts)
+    except Exception as e:
+        logger.error(f"Error storing file cache: {e}")
+
+def evict_file_cache(conn: sqlite3.Connection, now: float):
+    """Drop expired entries and the least recently used ones beyond FILE_CACHE_MAX_ENTRIES."""
+    conn.execute("DELETE FROM file_cache WHERE created_at <= ?", (now - FILE_CACHE_TTL,))
+    conn.execute(
+        "DELETE FROM file_cache WHERE cache_key IN ("
+        "  SELECT cache_key FROM file_cache GROUP BY cache_key"
+        "  ORDER BY MAX(last_used) DESC LIMIT -1 OFFSET ?"
+        ")",
+        (FILE_CACHE_MAX_ENTRIES,)
+    )
+
+def _get_file_cache_size(conn: sqlite3.Connection) -> int:
+    """Count cached keys."""
+    return conn.execute("SELECT COUNT(DISTINCT cache_key) FROM file_cache").fetchone()[0]
+
+async def get_file_cache_size() -> int:
+    """Get the number of cached URL+quality entries."""
+    try:
+        return await run_db(_get_file_cache_size)
+    except Exception as e:
+        logger.error(f"Error reading file cache size: {e}")
+        return 0
+
+# --- URL Tokens ---
+# Recently used tokens: token -> (url, stored_at), oldest use first
+_url_tokens: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+_url_token_writes = 0
+
+def make_url_token(url: str, attempt: int = 0) -> str:
+    """Derive a short token for a URL.
+
+    Tokens are derived from the URL itself, so they are the same across
+    restarts and worker processes; attempt picks an alternative on collision.
+    """
+    seed = url if attempt == 0 else f"{url}#{attempt}"
+    digest = hashlib.sha256(seed.encode('utf-8')).digest()
+    return base64.urlsafe_b64encode(digest[:9]).decode('ascii')
+
+def _store_url_token(conn: sqlite3.Connection, url: str, now: float, prune: bool) -> str:
+    """Save a URL under a free token (refreshing it if already stored) and return the token."""
+    with conn:
+        for attempt in range(URL_TOKEN_MAX_ATTEMPTS):
+            token = make_url_token(url, attempt)
+            row = conn.execute("SELECT url FROM url_tokens WHERE token = ?", (token,)).fetchone()
+            if row is None or row[0] == url:
+                conn.execute(
+                    "INSERT INTO url_tokens (token, url, created_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(token) DO UPDATE SET created_at = excluded.created_at",
+                    (token, url, now)
+                )
+                break
+        else:
+            raise Exception("No free URL token")
+        if prune:
+            conn.execute("DELETE FROM url_tokens WHERE created_at <= ?", (now - URL_TOKEN_TTL,))
+    return token
+
+def _get_url_token(conn: sqlite3.Connection, token: str, now: float) -> Optional[str]:
+    """Look up the URL stored under an unexpired token."""
+    row = conn.execute(
+        "SELECT url FROM url_tokens WHERE token = ? AND created_at > ?",
+        (token, now - URL_TOKEN_TTL)
+    ).fetchone()
+    return row[0] if row else None
+
+def remember_url_token(token: str, url: str, now: float):
+    """Keep a token in the in-memory LRU, evicting the least recently used beyond URL_TOKEN_MAX."""
+    _url_tokens[token] = (url, now)
+    _url_tokens.move_to_end(token)
+    while len(_url_tokens) > URL_TOKEN_MAX:
+        _url_tokens.popitem(last=False)
+
+async def store_url_token(url: str) -> str:
+    """Store a URL and return the short token used in callback data."""
+    global _url_token_writes
+    now = time.time()
+    token = None
+    if URL_TOKEN_PERSIST:
+        _url_token_writes += 1
+        try:
+            token = await run_db(_store_url_token, url, now, _url_token_writes % 100 == 0)
+        except Exception as e:
+            logger.error(f"Error storing URL token: {e}")
+    
+    if token is None:
+        # Memory only: pick the first token not taken by another URL
+        for attempt in range(URL_TOKEN_MAX_ATTEMPTS):
+            token = make_url_token(url, attempt)
+            if _url_tokens.get(token, (url,))[0] == url:
+                break
+    remember_url_token(token, url, now)
+    return token
+
+async def get_url_by_token(token: str) -> Optional[str]:
+    """Get the URL behind a callback token, or None if it is unknown or expired."""
+    now = time.time()
+    cached = _url_tokens.get(token)
+    if cached and cached[1] > now - URL_TOKEN_TTL:
+        _url_tokens.move_to_end(token)
+        return cached[0]
+    
+    url = None
+    if URL_TOKEN_PERSIST:
+        try:
+            url = await run_db(_get_url_token, token, now)
+        except Exception as e:
+            logger.error(f"Error reading URL token: {e}")
+    if url:
+        remember_url_token(token, url, now)
+    return url
+
+# --- Jobs ---
+# Every download is a row in the jobs table from the moment it is queued
+# until it finishes. The table is the queue between the frontend (the
+# process receiving updates) and the workers: a worker claims a job by
+# writing its WORKER_ID into it and keeps the claim alive with heartbeats.
+# The stage ('queued', 'downloading', 'sending') and send result are
+# saved as the job runs, so jobs of a worker that stopped are resumed by
+# the next worker that claims them.
+JOB_COLUMNS = "id, user_id, chat_id, message_id, url, quality, priority, stage, result"
+_worker_tasks: set = set()
+_worker_loop_task: Optional[asyncio.Task] = None
+_heartbeat_task: Optional[asyncio.Task] = None
+_sweep_task: Optional[asyncio.Task] = None
+_job_wakeup: Optional[asyncio.Event] = None
+
+def job_from_row(row: Tuple[Any, ...]) -> Dict[str, Any]:
+    """Build a job dict from a row selected with JOB_COLUMNS."""
+    job_id, user_id, chat_id, message_id, url, quality, priority, stage, result = row
+    return {'id': job_id, 'user_id': user_id, 'chat_id': chat_id, 'message_id': message_id,
+            'url': url, 'quality': quality, 'priority': priority, 'stage': stage,
+            'result': json.loads(result)}
+
+def _create_job(conn: sqlite3.Connection, user_id: int, chat_id: int, message_id: int, url: str,
+                quality: str, priority: int, flight_key: str, result: str, now: float) -> int:
+    """Insert a new job and return its id."""
+    with conn:
+        cursor = conn.execute(
+            "INSERT INTO jobs (user_id, chat_id, message_id, url, quality, priority, flight_key, result, "
+            "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, message_id, url, quality, priority, flight_key, result, now, now)
+        )
+    return cursor.lastrowid
+
+async def create_job(user_id: int, chat_id: int, message_id: int, url: str, quality: str,
+                     priority: int = PRIORITY_SINGLE) -> Dict[str, Any]:
+    """Queue a job for a new download request."""
+    result = new_send_result()
+    job_id = await run_db(_create_job, user_id, chat_id, message_id, url, quality, priority,
+                          get_flight_key(url, quality), json.dumps(result), time.time())
+    return {'id': job_id, 'user_id': user_id, 'chat_id': chat_id, 'message_id': message_id,
+            'url': url, 'quality': quality, 'priority': priority, 'stage': 'queued', 'result': result}
+
+def _get_queue_position(conn: sqlite3.Connection, job_id: int, priority: int) -> int:
+    """Count the unclaimed jobs that will be claimed before (and including) a job."""
+    return conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE worker IS NULL AND (priority < ? OR (priority = ? AND id <= ?))",
+        (priority, priority, job_id)
+    ).fetchone()[0]
+
+async def get_queue_position(job: Dict[str, Any]) -> int:
+    """1-based position of a queued job (0 if it has been claimed already)."""
+    try:
+        return await run_db(_get_queue_position, job['id'], job['priority'])
+    except Exception as e:
+        logger.error(f"Error reading queue position: {e}")
+        return 0
+
+def _save_job(conn: sqlite3.Connection, job_id: int, stage: str, result: str, now: float):
+    """Update the stage and send result of a job."""
+    with conn:
+        conn.execute("UPDATE jobs SET stage = ?, result = ?, updated_at = ? WHERE id = ?",
+                     (stage, result, now, job_id))
+
+async def save_job(job: Dict[str, Any], stage: Optional[str] = None):
+    """Persist a job's progress, optionally moving it to a new stage."""
+    if stage:
+        job['stage'] = stage
+    try:
+        await run_db(_save_job, job['id'], job['stage'], json.dumps(job['result']), time.time())
+    except Exception as e:
+        logger.error(f"Error saving job {job['id']}: {e}")
+
+def _delete_job(conn: sqlite3.Connection, job_id: int):
+    """Delete a job."""
+    with conn:
+        conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+async def finish_job(job: Dict[str, Any]):
+    """Forget a finished (or abandoned) job and remove its files."""
+    remove_job_dir(get_job_dir(job['id']))
+    try:
+        await run_db(_delete_job, job['id'])
+    except Exception as e:
+        logger.error(f"Error deleting job {job['id']}: {e}")
+
+def _claim_job(conn: sqlite3.Connection, worker_id: str, now: float) -> Optional[Dict[str, Any]]:
+    """Claim the next runnable job for a worker, or return None.
+
+    Jobs go in (priority, age) order, skipping users who already have
+    PER_USER_MAX_JOBS jobs running on any worker. Jobs for media that is
+    already being downloaded stay queued without taking a worker slot;
+    once the running job finishes they are answered from the file cache.
+    """
+    row = conn.execute(
+        f"SELECT {JOB_COLUMNS} FROM jobs WHERE worker IS NULL AND user_id NOT IN "
+        "(SELECT user_id FROM jobs WHERE worker IS NOT NULL GROUP BY user_id HAVING COUNT(*) >= ?) "
+        "AND NOT EXISTS (SELECT 1 FROM jobs AS running WHERE running.worker IS NOT NULL "
+        "AND running.flight_key = jobs.flight_key) "
+        "ORDER BY priority, id LIMIT 1",
+        (PER_USER_MAX_JOBS,)
+    ).fetchone()
+    if row is None:
+        return None
+    with conn:
+        # Another worker may have claimed it since the SELECT
+        cursor = conn.execute("UPDATE jobs SET worker = ?, heartbeat_at = ? WHERE id = ? AND worker IS NULL",
+                              (worker_id, now, row[0]))
+    return job_from_row(row) if cursor.rowcount == 1 else None
+
+def _requeue_stale_jobs(conn: sqlite3.Connection, now: float) -> List[Dict[str, Any]]:
+    """Put jobs of workers that stopped heartbeating back in the queue.
+
+    Jobs that have now failed this way more than JOB_MAX_ATTEMPTS times
+    are removed and returned, so their users can be told.
+    """
+    dropped = []
+    with conn:
+        conn.execute("UPDATE jobs SET worker = NULL, attempts = attempts + 1 "
+                     "WHERE worker IS NOT NULL AND heartbeat_at < ?", (now - WORKER_TIMEOUT,))
+        rows = conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs WHERE attempts > ?", (JOB_MAX_ATTEMPTS,)).fetchall()
+        for row in rows:
+            # Only the worker that deletes the row reports it
+            if conn.execute("DELETE FROM jobs WHERE id = ?", (row[0],)).rowcount == 1:
+                dropped.append(job_from_row(row))
+    return dropped
+
+async def drop_job(bot: Bot, job: Dict[str, Any]):
+    """Tell the user a job failed too often to be retried, and record it as failed."""
+    logger.warning(f"Dropping job {job['id']} ({job['url']}) after {JOB_MAX_ATTEMPTS} attempts")
+    remove_job_dir(get_job_dir(job['id']))
+    text = "❌ تعذر إكمال التحميل بعد عدة محاولات. يرجى إرسال الرابط مرة أخرى لاحقًا."
+    try:
+        if job['message_id']:
+            await get_status_message(bot, job['chat_id'], job['message_id']).edit_text(text)
+        else:
+            await bot.send_message(job['chat_id'], text)
+    except Exception as e:
+        logger.error(f"Error notifying chat {job['chat_id']} about dropped job {job['id']}: {e}")
+    await record_download(job['user_id'], detect_platform(job['url']), job['url'], job['quality'], 'failed')
+
+def _heartbeat_jobs(conn: sqlite3.Connection, worker_id: str, now: float):
+    """Mark all jobs claimed by a worker as still alive."""
+    with conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE worker = ?", (now, worker_id))
+
+def _release_jobs(conn: sqlite3.Connection, worker_id: str):
+    """Put the unfinished jobs of a stopping worker back in the queue."""
+    with conn:
+        conn.execute("UPDATE jobs SET worker = NULL WHERE worker = ?", (worker_id,))
+
+def _list_jobs(conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """List all unfinished jobs."""
+    return [job_from_row(row) for row in conn.execute(f"SELECT {JOB_COLUMNS} FROM jobs ORDER BY id")]
+
+def list_jobs() -> List[Dict[str, Any]]:
+    """List all unfinished jobs (called at startup, before the event loop runs)."""
+    try:
+        return run_db_sync(_list_jobs)
+    except Exception as e:
+        logger.error(f"Error loading unfinished jobs: {e}")
+        return []
+
+def wake_worker():
+    """Let an embedded worker claim a new job without waiting for its next poll."""
+    if _job_wakeup is not None:
+        _job_wakeup.set()
+
+async def worker_loop(bot: Bot):
+    """Claim queued jobs and run them while this worker has free slots."""
+    while True:
+        try:
+            for job in await run_db(_requeue_stale_jobs, time.time()):
+                await drop_job(bot, job)
+            while len(_worker_tasks) < MAX_CONCURRENT_DOWNLOADS:
+                job = await run_db(_claim_job, WORKER_ID, time.time())
+                if job is None:
+                    break
+                logger.info(f"Worker {WORKER_ID} claimed job {job['id']} ({job['url']})")
+                task = asyncio.ensure_future(run_job(bot, job))
+                _worker_tasks.add(task)
+                task.add_done_callback(_worker_tasks.discard)
+                task.add_done_callback(lambda _: wake_worker())
+        except Exception as e:
+            logger.error(f"Error claiming jobs: {e}")
+        
+        try:
+            await asyncio.wait_for(_job_wakeup.wait(), WORKER_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        _job_wakeup.clear()
+
+async def heartbeat_loop():
+    """Keep the claims of this worker's running jobs alive."""
+    while True:
+        await asyncio.sleep(WORKER_HEARTBEAT_INTERVAL)
+        try:
+            await run_db(_heartbeat_jobs, WORKER_ID, time.time())
+        except Exception as e:
+            logger.error(f"Error sending job heartbeat: {e}")
+
+async def storage_sweep_loop():
+    """Periodically remove downloaded files that no job owns."""
+    while True:
+        await asyncio.sleep(STORAGE_SWEEP_INTERVAL)
+        try:
+            job_ids = {job['id'] for job in await run_db(_list_jobs)} | set(storage.reservations)
+            await asyncio.get_running_loop().run_in_executor(None, storage.sweep, job_ids, time.time())
+        except Exception as e:
+            logger.error(f"Error sweeping downloads: {e}")
+
+async def start_worker(bot: Bot):
+    """Start claiming and running jobs in this process."""
+    global _worker_loop_task, _heartbeat_task, _sweep_task, _job_wakeup
+    _job_wakeup = asyncio.Event()
+    _worker_loop_task = asyncio.ensure_future(worker_loop(bot))
+    _heartbeat_task = asyncio.ensure_future(heartbeat_loop())
+    _sweep_task = asyncio.ensure_future(storage_sweep_loop())
+    logger.info(f"Worker {WORKER_ID} started")
+
+async def stop_worker():
+    """Stop the worker and hand its unfinished jobs back to the queue."""
+    global _worker_loop_task, _heartbeat_task, _sweep_task, _job_wakeup
+    if _worker_loop_task is None:
+        return
+    for task in (_worker_loop_task, _heartbeat_task, _sweep_task, *_worker_tasks):
+        task.cancel()
+    await asyncio.gather(_worker_loop_task, _heartbeat_task, _sweep_task, *_worker_tasks, return_exceptions=True)
+    _worker_loop_task = _heartbeat_task = _sweep_task = _job_wakeup = None
+    try:
+        await run_db(_release_jobs, WORKER_ID)
+    except Exception as e:
+        logger.error(f"Error releasing jobs: {e}")
+
+# --- Metrics Endpoint ---
+def _get_queue_stats(conn: sqlite3.Connection, now: float) -> Tuple[int, int, int]:
+    """Count queued jobs, running jobs and live workers across all processes."""
+    return conn.execute(
+        "SELECT COALESCE(SUM(worker IS NULL), 0), COALESCE(SUM(worker IS NOT NULL), 0), "
+        "COUNT(DISTINCT CASE WHEN heartbeat_at >= ? THEN worker END) FROM jobs",
+        (now - WORKER_TIMEOUT,)
+    ).fetchone()
+
+# Last (queued, running, workers) counts and when they were read
+_queue_stats: Tuple[float, Tuple[int, int, int]] = (0.0, (0, 0, 0))
+_queue_stats_lock = threading.Lock()
+
+def get_queue_stats() -> Tuple[int, int, int]:
+    """Queued jobs, running jobs and live workers (callable from any thread).
+
+    The counts are read once per QUEUE_STATS_TTL, so the gauges of one
+    scrape share a query; after the database is closed the last counts
+    are returned.
+    """
+    global _queue_stats
+    with _queue_stats_lock:
+        read_at, stats = _queue_stats
+        now = time.time()
+        if not _db_closed and now - read_at >= QUEUE_STATS_TTL:
+            stats = run_db_sync(_get_queue_stats, now)
+            _queue_stats = (now, stats)
+        return stats
+
+Metric('bot_jobs_queued', 'gauge', 'Jobs waiting for a worker', func=lambda: get_queue_stats()[0])
+Metric('bot_jobs_running', 'gauge', 'Jobs claimed by a worker', func=lambda: get_queue_stats()[1])
+Metric('bot_workers_active', 'gauge', 'Workers with a running job that heartbeated recently',
+       func=lambda: get_queue_stats()[2])
+Metric('bot_worker_jobs', 'gauge', 'Jobs running in this process', func=lambda: len(_worker_tasks))
+Metric('bot_storage_reserved_bytes', 'gauge', 'Disk space reserved by jobs in this process',
+       func=lambda: sum(list(storage.reservations.values())))
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics in the Prometheus text format."""
+    
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass  # Scrapes would flood the log
+
+def start_metrics_server():
+    """Serve /metrics from a background thread, if METRICS_PORT is set."""
+    if not METRICS_PORT:
+        return
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, METRICS_PORT), MetricsHandler)
+    except OSError as e:
+        # e.g. another process on this host already serves its metrics there
+        logger.warning(f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+# --- Leader Election ---
+# Only one process may receive updates (polling or webhook). Candidates
+# compete for a lease row in the database; the holder renews it well
+# before it expires, and a standby takes over once it does.
+FRONTEND_LEASE = 'frontend'
+_lease_task: Optional[asyncio.Task] = None
+
+def _acquire_lease(conn: sqlite3.Connection, name: str, holder: str, now: float) -> bool:
+    """Take or renew a lease; returns True if holder now has it."""
+    with conn:
+        conn.execute(
+            "INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+            "WHERE leases.holder = excluded.holder OR leases.expires_at < ?",
+            (name, holder, now + LEASE_TTL, now)
+        )
+    row = conn.execute("SELECT holder FROM leases WHERE name = ?", (name,)).fetchone()
+    return row is not None and row[0] == holder
+
+def _release_lease(conn: sqlite3.Connection, name: str, holder: str):
+    """Give up a lease so a standby can take over right away."""
+    with conn:
+        conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+def wait_for_leadership():
+    """Block until this process holds the frontend lease."""
+    announced = False
+    while True:
+        try:
+            if run_db_sync(_acquire_lease, FRONTEND_LEASE, WORKER_ID, time.time()):
+                logger.info(f"{WORKER_ID} is the active frontend")
+                return
+        except Exception as e:
+            logger.error(f"Error acquiring frontend lease: {e}")
+        if not announced:
+            logger.info("Another instance is the active frontend; waiting on standby...")
+            announced = True
+        time.sleep(LEASE_TTL / 3)
+
+async def lease_loop(application: Application):
+    """Renew the frontend lease; stop receiving updates if it was lost."""
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        try:
+            held = await run_db(_acquire_lease, FRONTEND_LEASE, WORKER_ID, time.time())
+        except Exception as e:
+            logger.error(f"Error renewing frontend lease: {e}")
+            continue
+        if not held:
+            logger.error("Lost the frontend lease to another instance; stopping")
+            application.stop_running()
+            return
+
 async def notify_admin_about_new_user(context, user):
     """Send notification to admin about new user."""
     if not ADMIN_ID:
@@ -826,7 +3711,7 @@ async def notify_admin_about_new_user(context, user):
     
     try:
         # Get stats
-        stats = get_user_stats()
+        stats = await get_user_stats()
         
         # Format user info
         user_info = (
@@ -867,7 +3752,7 @@ async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # Get stats from database
-    stats = get_user_stats()
+    stats = await get_user_stats()
     
     # Format platform stats
     platform_text = ""
@@ -886,13 +3771,48 @@ async def stats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not users_text:
         users_text = "• لا يوجد مستخدمين بعد\n"
     
+    # Format file cache stats
+    hits = int(CACHE_LOOKUPS.total(cache='file', result='hit'))
+    misses = int(CACHE_LOOKUPS.total(cache='file', result='miss'))
+    hit_rate = (hits * 100 // (hits + misses)) if hits + misses else 0
+    cache_text = (
+        f"• الملفات المخزنة: {await get_file_cache_size()}\n"
+        f"• مرات الاستخدام: {hits} | مرات عدم الإيجاد: {misses} ({hit_rate}%)\n"
+    )
+    
+    # Format timings of the request stages since startup
+    performance_text = ""
+    for stage in ('subscription', 'probe', 'download', 'merge', 'transcode', 'split', 'upload', 'request'):
+        series = STAGE_SECONDS.merged(stage=stage)
+        if not series or not series[2]:
+            continue
+        buckets, total, count = series
+        p95 = histogram_quantile(buckets, count, 0.95, STAGE_SECONDS.buckets)
+        p95_text = f"≤{p95}s" if p95 is not None else f">{STAGE_SECONDS.buckets[-1]}s"
+        performance_text += f"• {stage}: {count} مرة، المتوسط {total / count:.1f}s، p95 {p95_text}\n"
+    try:
+        queued, running, workers = await run_db(_get_queue_stats, time.time())
+    except Exception as e:
+        logger.error(f"Error reading queue stats: {e}")
+        queued = running = workers = 0
+    performance_text += (
+        f"• في الانتظار: {queued} | قيد التنفيذ: {running} | العمّال: {workers}\n"
+        f"• تم تنزيل: {format_size(DOWNLOADED_BYTES.total())} | تم رفع: {format_size(UPLOADED_BYTES.total())}\n"
+        f"• الأخطاء: {int(ERRORS.total())}\n"
+    )
+    
     # Compose message
     message = (
         "📊 <b>إحصائيات البوت</b>\n\n"
         f"👥 <b>إجمالي المستخدمين:</b> {stats['total_users']}\n"
-        f"📥 <b>إجمالي التنزيلات:</b> {stats['total_downloads']}\n\n"
+        f"📥 <b>إجمالي التنزيلات:</b> {stats['total_downloads']}\n"
+        f"📅 <b>تنزيلات اليوم:</b> {stats['today_downloads']}\n\n"
         "<b>التنزيلات حسب المنصة:</b>\n"
         f"{platform_text}\n"
+        "<b>ذاكرة الملفات المرسلة:</b>\n"
+        f"{cache_text}\n"
+        "<b>الأداء منذ آخر تشغيل:</b>\n"
+        f"{performance_text}\n"
         "<b>آخر المستخدمين:</b>\n"
         f"{users_text}"
     )
@@ -937,18 +3857,35 @@ async def admin_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def error_handler(update, context):
     """Handle errors in telegram-bot-api."""
     logger.error(f"Update {update} caused error {context.error}")
+    ERRORS.inc(stage='handler')
     
     if update and update.effective_chat:
         await update.effective_chat.send_message(
             "⚠️ حدث خطأ أثناء معالجة طلبك. الرجاء المحاولة مرة أخرى لاحقًا."
         )
 
-def cleanup_downloads():
-    """Clean up downloads directory."""
+def cleanup_downloads(jobs: Optional[List[Dict[str, Any]]] = None):
+    """Clean up downloads directory, keeping the directories of unfinished jobs.
+
+    Recent-files entries are kept unless they are older than ORPHAN_MAX_AGE,
+    since live workers may still be sending from them.
+    """
+    keep = {get_job_dir(job['id']) for job in jobs or []}
+    now = time.time()
     try:
         if os.path.exists(DOWNLOAD_DIR):
             for file in os.listdir(DOWNLOAD_DIR):
                 file_path = os.path.join(DOWNLOAD_DIR, file)
+                if file_path in keep:
+                    continue
+                if file_path == RECENT_DIR:
+                    for entry in os.scandir(RECENT_DIR):
+                        try:
+                            if now - entry.stat().st_mtime >= ORPHAN_MAX_AGE:
+                                remove_job_dir(entry.path)
+                        except FileNotFoundError:
+                            pass
+                    continue
                 try:
                     if os.path.isfile(file_path):
                         os.unlink(file_path)
@@ -959,79 +3896,20 @@ def cleanup_downloads():
     except Exception as e:
         logger.error(f"Error cleaning downloads: {e}")
 
-def main():
-    """Initialize and start the bot."""
-    # Get a clean start by killing anything related first
-    try:
-        import os
-        import signal
-        import subprocess
-        import glob
-        
-        # Remove any lock files that might exist from previous runs
-        for lock_file in glob.glob("*.lock"):
-            try:
-                os.remove(lock_file)
-                logger.info(f"Removed stale lock file: {lock_file}")
-            except Exception as e:
-                logger.warning(f"Failed to remove lock file {lock_file}: {e}")
-        
-        # Use pkill to terminate any existing Python processes running this script
-        try:
-            subprocess.run(["pkill", "-9", "-f", "python.*downloads1.py"], 
-                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            logger.info("Terminated any existing bot processes")
-            time.sleep(2)  # Give processes time to terminate
-        except Exception as e:
-            logger.warning(f"pkill command failed: {e}")
-    except Exception as e:
-        logger.warning(f"Error during cleanup: {e}")
-    
-    # Initialize database
-    init_database()
-    
-    # Clean up any old downloads
-    cleanup_downloads()
-    
-    # Ensure the download directory exists
-    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-    
-    # Create lock file with timeout verification
-    lock_file = "bot_instance.lock"
-    pid = os.getpid()
-    lock_data = f"{pid}:{int(time.time())}"
-    
-    try:
-        # Only proceed if we can create the lock file
-        if os.path.exists(lock_file):
-            # Check if the lock is stale (older than 1 minute)
-            with open(lock_file, 'r') as f:
-                old_data = f.read().strip()
-                try:
-                    old_pid, timestamp = old_data.split(":")
-                    if int(time.time()) - int(timestamp) < 60:
-                        logger.error(f"Another bot instance is already running (PID: {old_pid})")
-                        return
-                except:
-                    pass  # Invalid lock file format, we'll overwrite it
-            
-        # Write our PID to the lock file
-        with open(lock_file, 'w') as f:
-            f.write(lock_data)
-        logger.info(f"Created lock file for PID {pid}")
-    except Exception as e:
-        logger.error(f"Error managing lock file: {e}")
-        # We'll continue anyway
-    
-    try:
-        # Log basic information for troubleshooting
-        logger.info(f"Bot token (masked): {TOKEN[:5]}...{TOKEN[-5:]}")
-        logger.info(f"Python version: {sys.version}")
-        logger.info(f"Current working directory: {os.getcwd()}")
-        
-        # Create the Application
-        application = Application.builder().token(TOKEN).build()
+def build_application(frontend: bool = True) -> Application:
+    """Create the Application, with handlers when it is going to receive updates."""
+    # Updates are handled concurrently so long downloads don't hold up other users
+    builder = Application.builder().token(TOKEN).concurrent_updates(True)
+    if frontend:
+        builder = builder.post_init(on_startup).post_shutdown(on_shutdown)
+    if BOT_API_BASE_URL:
+        # Self-hosted Bot API server: larger uploads, optionally straight from disk
+        builder = builder.base_url(BOT_API_BASE_URL).base_file_url(BOT_API_BASE_FILE_URL)
+        builder = builder.local_mode(BOT_API_LOCAL_MODE)
+        logger.info(f"Using Bot API server {BOT_API_BASE_URL} (local mode: {BOT_API_LOCAL_MODE})")
+    application = builder.build()
     
+    if frontend:
         # Register handlers
         application.add_handler(CommandHandler("start", start_handler))
         application.add_handler(CommandHandler("help", help_handler))
@@ -1043,28 +3921,138 @@ def main():
         
         # Register error handler
         application.add_error_handler(error_handler)
+    return application
+
+def prepare_downloads():
+    """Clean up old downloads, except the partial files of unfinished jobs.
+
+    Only the leader does this; a worker process starting next to live ones
+    must not remove what they are downloading or sending.
+    """
+    cleanup_downloads(list_jobs())
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+def main():
+    """Initialize and start the bot (the frontend, plus a worker if EMBEDDED_WORKER)."""
+    # Initialize database
+    init_database()
+    
+    # Only one instance receives updates; others wait on standby
+    wait_for_leadership()
+    start_metrics_server()
+    prepare_downloads()
+    
+    try:
+        # Log basic information for troubleshooting
+        logger.info(f"Bot token (masked): {TOKEN[:5]}...{TOKEN[-5:]}")
+        logger.info(f"Python version: {sys.version}")
+        logger.info(f"Current working directory: {os.getcwd()}")
+        
+        application = build_application()
         
         # Start the Bot - drop pending updates to avoid backlog
-        logger.info("Starting bot polling...")
-        application.run_polling(
-            drop_pending_updates=True,
-            connect_timeout=30,
-            read_timeout=30,
-            write_timeout=30,
-            pool_timeout=30
-        )
+        if WEBHOOK_URL:
+            logger.info(f"Starting bot webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}...")
+            application.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                drop_pending_updates=True
+            )
+        else:
+            logger.info("Starting bot polling...")
+            application.run_polling(
+                drop_pending_updates=True,
+                connect_timeout=30,
+                read_timeout=30,
+                write_timeout=30,
+                pool_timeout=30
+            )
     except Exception as e:
         logger.error(f"Fatal error in main bot process: {e}")
         import traceback
         logger.error(f"Traceback: {traceback.format_exc()}")
     finally:
-        # Clean up lock file when the bot exits
-        try:
-            if os.path.exists(lock_file):
-                os.remove(lock_file)
-                logger.info("Removed lock file on exit")
-        except Exception as e:
-            logger.warning(f"Failed to remove lock file: {e}")
+        shutdown_download_executor()
+
+def run_worker():
+    """Run a worker process that only claims and runs queued jobs."""
+    init_database()
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    start_metrics_server()
+    application = build_application(frontend=False)
+    
+    async def serve():
+        global _download_flush_task
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        
+        async with application:
+            _download_flush_task = asyncio.ensure_future(download_flush_loop())
+            await start_worker(application.bot)
+            await stop.wait()
+            logger.info(f"Worker {WORKER_ID} stopping")
+            await stop_worker()
+            _download_flush_task.cancel()
+        await close_database()
+    
+    try:
+        asyncio.run(serve())
+    finally:
+        shutdown_download_executor()
+
+BENCH_URLS = [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ&utm_source=share&si=abc',
+    'https://youtu.be/dQw4w9WgXcQ?t=42',
+    'https://m.youtube.com/shorts/dQw4w9WgXcQ',
+    'https://www.youtube.com/playlist?list=PLx0sYbCqOb8TBPRdmBHs5Iftvv9TPboYG',
+    'https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC?si=123',
+    'https://open.spotify.com/album/1DFixLWuPkv3KT3TnV35m3',
+    'https://www.instagram.com/reel/C1a2b3c4d5e/?igsh=xyz',
+    'https://www.tiktok.com/@user/video/7234567890123456789',
+    'https://x.com/user/status/1234567890123456789',
+    'https://soundcloud.com/artist/track-name',
+    'https://example.com/media/clip.mp4?id=7&fbclid=abc',
+]
+
+def bench_urls(iterations: int):
+    """Print the per-call cost of URL parsing, uncached and cached."""
+    parse = parse_media_url.__wrapped__
+    calls = iterations * len(BENCH_URLS)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for url in BENCH_URLS:
+            parse(url)
+    uncached = time.perf_counter() - start
+    
+    parse_media_url.cache_clear()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for url in BENCH_URLS:
+            get_media_key(url)
+    cached = time.perf_counter() - start
+    
+    for url in BENCH_URLS:
+        print(f"{get_media_key(url) or '-':<45} {url}")
+    print(f"parse_media_url (uncached): {uncached / calls * 1e6:.2f} µs/call")
+    print(f"get_media_key (cached):     {cached / calls * 1e6:.2f} µs/call")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Telegram media downloader bot")
+    parser.add_argument('command', nargs='?', default='bot', choices=['bot', 'worker', 'bench-urls'],
+                        help="'bot' receives updates (and runs jobs unless EMBEDDED_WORKER=0); "
+                             "'worker' only runs queued jobs; "
+                             "'bench-urls' times URL parsing")
+    parser.add_argument('--iterations', type=int, default=10000,
+                        help="rounds over the sample URLs for bench-urls")
+    args = parser.parse_args()
+    if args.command == 'worker':
+        run_worker()
+    elif args.command == 'bench-urls':
+        bench_urls(args.iterations)
+    else:
+        main()